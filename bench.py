@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+# Benchmark for the lamusica.py pipeline: synthetic midi files from tiny
+# to huge are generated and every stage is timed on its own. The results
+# are written as JSON so runs of different commits can be compared.
+
+import sys, getopt, time, json, os, random, struct, tempfile
+import io, contextlib, platform, subprocess, importlib.util
+
+import lamusica
+
+
+# name: (tracks, notes per track, tempo changes, running status, meta events)
+sizes = {
+   "tiny"   : (1,     50,  0, False, False),
+   "small"  : (4,    500,  4, True,  True),
+   "medium" : (8,   5000, 20, True,  True),
+   "large"  : (16, 20000, 50, True,  True),
+   "huge"   : (16, 200000, 200, True, True),
+}
+
+
+def vlq (value):
+   out = [value & 0x7f]
+   value >>= 7
+   while value:
+      out.append (0x80 | (value & 0x7f))
+      value >>= 7
+   return bytes (reversed (out))
+
+
+def synth_midi (tracks, notes, tempos=0, running=True, meta=True, seed=1):
+   # A type 1 midi file as bytes: every track plays notes random in pitch
+   # and timing on a 16th grid, tempo changes are spread over the first
+   # track. meta adds a long text event and a sysex to every track.
+   r = random.Random (seed)
+   data = bytearray (struct.pack (">4sIhhh", b"MThd", 6, 1, tracks, 480))
+   every = notes // tempos if tempos else 0
+   for track in range (tracks):
+      ev = bytearray ()
+      if meta:
+         ev += vlq (0) + b"\xff\x03" + vlq (200) + b"lamusica" * 25
+         ev += vlq (0) + b"\xf0" + vlq (5) + b"\x7e\x7f\x09\x01\xf7"
+      channel = track % 16
+      ev += vlq (0) + bytes ((0xc0 | channel, track % 128))
+      centre = r.randint (48, 72)
+      status = None
+      for i in range (notes):
+         if track == 0 and every and i % every == 0:
+            tempo = r.choice ((400000, 500000, 600000, 750000))
+            ev += vlq (0) + b"\xff\x51\x03" + tempo.to_bytes (3, "big")
+            status = None
+         note = max (0, min (127, centre + r.randint (-12, 12)))
+         for delta, velocity in ((r.choice ((0, 120, 120, 240, 480)), 100), (60, 0)):
+            ev += vlq (delta)
+            if not (running and status == 0x90 | channel):
+               ev.append (0x90 | channel)
+               status = 0x90 | channel
+            ev += bytes ((note, velocity))
+      ev += vlq (0) + b"\xff\x2f\x00"
+      data += b"MTrk" + struct.pack (">I", len (ev)) + ev
+   return bytes (data)
+
+
+def usage ():
+   sys.stderr.write( "Usage: %s [arguments]\n" % sys.argv[0])
+   sys.stderr.write( "  -h, --help: show usage\n")
+   sys.stderr.write( "  -s, --sizes=name,...: inputs to run (default: tiny,small,medium; all: %s)\n" % ",".join (sizes))
+   sys.stderr.write( "  -b, --box=name: the box model (default: sankyo20)\n")
+   sys.stderr.write( "  -r, --repeat=number: runs per input, the fastest counts (default: 3)\n")
+   sys.stderr.write( "  -o, --output=file.json: write the results there instead of stdout\n")
+   sys.stderr.write( "      --no-render: skip output_file (it needs pycairo)\n")
+
+
+def timed (stages, name, func, *args):
+   start = time.perf_counter ()
+   result = func (*args)
+   stages[name] = time.perf_counter () - start
+   return result
+
+
+def run_pipeline (filename, model, outdir, render):
+   # one pass over all stages, returns (seconds per stage, counts)
+   stages = {}
+   roll = lamusica.CompactPianoRoll ()
+   mi = lamusica.MidiImporter (roll)
+   with contextlib.redirect_stderr (io.StringIO ()), \
+        contextlib.redirect_stdout (io.StringIO ()):
+      timed (stages, "import_file", mi.import_file, filename)
+      tempo_map = mi.tempo_map ()
+      timed (stages, "retime", roll.retime, tempo_map)
+      filtered = timed (stages, "filter_repetition", roll.filter_repetition, 1)
+      roll.transpose = timed (stages, "find_transpose", roll.find_transpose, model.pitches)
+      notelist = timed (stages, "get_compat_band", roll.get_compat_band, model)
+      mindelta = timed (stages, "min_repetition", roll.min_repetition)
+      timed (stages, "output_midi", lamusica.output_midi, model,
+             os.path.join (outdir, "out.mid"), notelist, mindelta, mi.timediv,
+             tempo_map.tempo)
+      if importlib.util.find_spec ("numpy"):
+         timed (stages, "output_wav", lamusica.output_wav, model,
+                os.path.join (outdir, "out.wav"), notelist, mi.timediv, tempo_map.tempo)
+      timed (stages, "output_preview", lamusica.output_preview, model,
+             os.path.join (outdir, "out.png"), notelist, mindelta)
+      if render:
+         timed (stages, "output_file", lamusica.output_file, model,
+                os.path.join (outdir, "out.pdf"), True, notelist, mindelta)
+   counts = { "notes"    : len (roll),
+              "filtered" : filtered,
+              "holes"    : sum (map (len, notelist)) }
+   return stages, counts
+
+
+def bench (names, box, repeat, render):
+   model = lamusica.models[box]
+   results = []
+   with tempfile.TemporaryDirectory () as outdir:
+      for name in names:
+         tracks, notes, tempos, running, meta = sizes[name]
+         filename = os.path.join (outdir, name + ".mid")
+         with open (filename, "wb") as f:
+            f.write (synth_midi (tracks, notes, tempos, running, meta))
+         best = {}
+         for i in range (repeat):
+            stages, counts = run_pipeline (filename, model, outdir, render)
+            for stage, seconds in stages.items ():
+               best[stage] = min (best.get (stage, seconds), seconds)
+         results.append ({ "input"  : name,
+                           "tracks" : tracks,
+                           "bytes"  : os.path.getsize (filename),
+                           "counts" : counts,
+                           "stages" : best,
+                           "total"  : sum (best.values ()) })
+   return results
+
+
+def revision ():
+   try:
+      return subprocess.run (["git", "describe", "--always", "--dirty"],
+                             cwd=os.path.dirname (os.path.abspath (__file__)),
+                             capture_output=True, text=True).stdout.strip () or None
+   except OSError:
+      return None
+
+
+if __name__=='__main__':
+   try:
+      opts, args = getopt.gnu_getopt (sys.argv[1:], "hs:b:r:o:",
+                                      ["help", "sizes=", "box=", "repeat=",
+                                       "output=", "no-render"])
+   except getopt.GetoptError as err:
+      usage()
+      sys.exit (2)
+
+   names = ["tiny", "small", "medium"]
+   box = "sankyo20"
+   repeat = 3
+   output = None
+   render = True
+
+   for o, a in opts:
+      if o in ("-h", "--help"):
+         usage()
+         sys.exit()
+      elif o in ("-s", "--sizes"):
+         names = list (sizes) if a == "all" else a.split (",")
+      elif o in ("-b", "--box"):
+         box = a
+      elif o in ("-r", "--repeat"):
+         repeat = int (a)
+      elif o in ("-o", "--output"):
+         output = a
+      elif o == "--no-render":
+         render = False
+      else:
+         assert False, "unhandled option"
+
+   for name in names:
+      if name not in sizes:
+         sys.stderr.write ("unknown size %s\n" % name)
+         sys.exit (2)
+   if box not in lamusica.models:
+      sys.stderr.write ("unknown box %s\n" % box)
+      sys.exit (2)
+
+   report = { "revision" : revision (),
+              "python"   : platform.python_version (),
+              "box"      : box,
+              "repeat"   : repeat,
+              "results"  : bench (names, box, repeat, render) }
+
+   for r in report["results"]:
+      sys.stderr.write ("%-7s %8d notes  %s  total %.3fs\n" %
+                        (r["input"], r["counts"]["notes"],
+                         "  ".join ("%s %.3fs" % s for s in r["stages"].items ()),
+                         r["total"]))
+
+   if output:
+      with open (output, "w") as f:
+         json.dump (report, f, indent=2)
+   else:
+      print (json.dumps (report, indent=2))
@@ -1,14 +1,26 @@
 #!/usr/bin/env python
 # (c) 2011-2017 Simon Budig <simon@budig.de>
 
-import sys, struct, math, getopt, pdb
-import cairo
+import sys, struct, math, getopt
+import array, bisect, collections, heapq, itertools, operator
+import contextlib, io, os, time, zlib
+# cairo, concurrent.futures, asyncio, the email/url modules and those for
+# the cache, stats and summaries are only imported by the outputs and
+# modes that need them, to start fast
 
 # Mensch macht bequem ca. 120-180 UPM.
-
-delta_ticks = 0
-
-models = {
+crank_rpm = 180
+
+# The box models, more can be loaded from a file with --models. The notes
+# are the tines in halftones above lowest, the dimensions in mm: the
+# height of the strip, the offset of the first tine from its edge, the
+# distance between the tines, the diameter of the holes, the step
+# between consecutive chords and optionally the speed in mm per turn of
+# the crank and the recovery, the distance a tine needs to sound again.
+# Instead of the recovery the recovery_time in s can be given, with the
+# speed it makes the paper that passes at crank_rpm in that time. Without
+# either it is one step.
+box_definitions = {
    # https://www.spieluhr.de/Artikel/varAussehen.asp?ArtikelNr=4905
    "sankyo15" : {
       # Gis Dur? SRSLY?
@@ -96,67 +108,371 @@ models = {
 }
 
 
-def output_file (model, filename, is_pdf, notelist, mindelta):
-   # This is 2x A4 in  millimeters.
-   # pwidth  = 420.0
-   # pheight = 297.0
+# field: (type, required)
+box_fields = {
+   "lowest"   : (int,   True),
+   "notes"    : (list,  True),
+   "program"  : (int,   True),
+   "height"   : (float, True),
+   "offset"   : (float, True),
+   "distance" : (float, True),
+   "diameter" : (float, True),
+   "step"     : (float, True),
+   "speed"    : (float, False),
+   "recovery" : (float, False),
+   "recovery_time" : (float, False),
+}
 
-   # pwidth  = 700.0 - 20
-   # pheight = 500.0 - 20
 
-   # US Letter:
-   # 215.9mm x 279.4mm
-   #pwidth  = 279.4
-   #pheight = 215.9
+def fold_sources (notes, i):
+   # the midi notes that get played on tine i: its own note and the
+   # octaves above and below that have no tine of their own
+   source_notes = [notes[i]]
+   n = notes[i] - 12
+   while n >= 0 and n not in notes:
+      source_notes.append (n)
+      n -= 12
+   n = notes[i] + 12
+   while n <= 127 and  n not in notes:
+      source_notes.append (n)
+      n += 12
+   return source_notes
+
+
+class BoxModel (object):
+   # A box definition, checked once, with what the pipeline looks up per
+   # note precomputed: the midi note of every tine (pitches), a 128 entry
+   # bitmap of the playable midi notes and the tines every midi note is
+   # folded onto, per transposition. model["step"] reads a field like
+   # from the definition dict.
+
+   __slots__ = tuple (box_fields) + ("name", "key", "pitches", "playable",
+                                     "fold_tables")
+
+   def __init__ (self, name, definition):
+      if not isinstance (definition, dict):
+         raise Exception("box %s: definition is not a table of fields" % name)
+      for field in definition:
+         if field not in box_fields:
+            raise Exception("box %s: unknown field %s" % (name, field))
+      for field, (kind, required) in box_fields.items ():
+         value = definition.get (field)
+         if value is None:
+            if required:
+               raise Exception("box %s: %s is missing" % (name, field))
+         elif kind is float:
+            if isinstance (value, bool) or not isinstance (value, (int, float)):
+               raise Exception("box %s: %s is not a number" % (name, field))
+            value = float (value)
+         elif kind is int:
+            if isinstance (value, bool) or not isinstance (value, int):
+               raise Exception("box %s: %s is not an integer" % (name, field))
+         elif kind is list:
+            if (not isinstance (value, list) or
+                any (isinstance (n, bool) or not isinstance (n, int) for n in value)):
+               raise Exception("box %s: %s is not a list of integers" % (name, field))
+            value = tuple (value)
+         setattr (self, field, value)
+
+      if self.recovery_time is not None:
+         if self.speed is None:
+            raise Exception("box %s: recovery_time needs the speed" % name)
+         if self.recovery is None and self.recovery_time > 0:
+            self.recovery = self.recovery_time * self.speed * crank_rpm / 60.
+      if self.recovery is None:
+         self.recovery = self.step
+      if not self.notes or list (self.notes) != sorted (set (self.notes)):
+         raise Exception("box %s: notes must rise from tine to tine" % name)
+      if not 0 <= self.lowest + self.notes[0] <= self.lowest + self.notes[-1] <= 127:
+         raise Exception("box %s: notes outside of the midi range" % name)
+      if not 0 <= self.program <= 127:
+         raise Exception("box %s: program outside of the midi range" % name)
+      for field in ("height", "distance", "diameter", "step", "speed",
+                    "recovery", "recovery_time"):
+         if getattr (self, field) is not None and getattr (self, field) <= 0:
+            raise Exception("box %s: %s must be positive" % (name, field))
+      if self.offset < 0:
+         raise Exception("box %s: offset is negative" % name)
+
+      self.name = name
+      # the cache key, the name does not change the results
+      self.key = tuple ((field, getattr (self, field)) for field in box_fields)
+      self.pitches = tuple (n + self.lowest for n in self.notes)
+      playable = bytearray (128)
+      for n in self.pitches:
+         playable[n] = 1
+      self.playable = bytes (playable)
+      tines = [[] for i in range (128)]
+      for i in range (len (self.pitches)):
+         for n in fold_sources (self.pitches, i):
+            tines[n].append (i)
+      self.fold_tables = { 0 : [tuple (t) for t in tines] }
 
-   # US Letter with a 10mm border
-   pwidth  = 269.4
-   pheight = 205.9
 
-   # US Legal
-   #pwidth = 356
-   #pheight = 215.9
+   def __repr__ (self):
+      return "BoxModel (%r)" % self.name
 
-   # US Legal 2
-   #pwidth = 336
-   #pheight = 195.9
-
-   #pheight = 228.6
-   #pwidth = 304.8
-
-   pborder = 3
-   #pborder = 10    - 8
-   height  = model["height"]
-   offset  = model["offset"]
-   radius  = model["diameter"] / 2
-   dist    = model["distance"]
-   step    = model["step"] / mindelta
-   leadin  = 20.0
-   leadout = 20.0
 
-   alltimes = list (set (sum (notelist, [])))
-   alltimes.sort ()
-   start   = alltimes[0]
-   end     = alltimes[-1]
-   length  = int (end - start) * step + radius * 2 + leadin + leadout
+   def __getitem__ (self, field):
+      if field not in box_fields:
+         raise KeyError (field)
+      return getattr (self, field)
+
+
+   def get (self, field, default=None):
+      return getattr (self, field) if field in box_fields else default
+
 
+   def fold_table (self, transpose=0):
+      # 128 entries: the tines a (untransposed) midi note gets played on.
+      # Usually one tine, none for pitch classes the box does not have and
+      # two for octaves halfway between two tines of the same pitch class.
+      if transpose not in self.fold_tables:
+         folds = self.fold_tables[0]
+         self.fold_tables[transpose] = [folds[p + transpose] if 0 <= p + transpose <= 127
+                                        else () for p in range (128)]
+      return self.fold_tables[transpose]
+
+
+   def mm_per_tick (self, mindelta):
+      # the shortest repetition of a pitch, mindelta ticks, is one step
+      return self.step / mindelta
+
+
+   def unplayable (self, index, transpose):
+      # notes of a pitch index not directly playable when transposed
+      playable = self.playable
+      return sum (len (index[p]) for p in range (128)
+                  if index[p] and not (0 <= p + transpose <= 127 and playable[p + transpose]))
+
+
+def load_models (filename):
+   # BoxModels from a JSON or TOML file, a table of definitions by name
+   # like box_definitions
+   with open (filename, "rb") as f:
+      data = f.read ()
+   if filename.lower ().endswith (".toml"):
+      try:
+         import tomllib
+      except ImportError:
+         raise Exception("TOML box models need Python 3.11 or newer, JSON works too")
+      definitions = tomllib.loads (data.decode ("utf-8"))
+   else:
+      import json
+      definitions = json.loads (data)
+   if not isinstance (definitions, dict):
+      raise Exception("%s: not a table of box definitions" % filename)
+   return dict ((name, BoxModel (name, d)) for name, d in definitions.items ())
+
+
+models = dict ((name, BoxModel (name, d)) for name, d in box_definitions.items ())
+
+
+def read_vlq (data, pos):
+   # decode a MIDI variable length quantity, return (value, new offset)
+   value = 0
+   while data[pos] & 0x80:
+      value = (value | (data[pos] & 0x7f)) << 7
+      pos += 1
+   return value | data[pos], pos + 1
+
+
+def split_greedy (alltimes, step, radius, leadin, length, maxwidth):
+   # break in the last wide gap before the strip gets too long
+   start = alltimes[0]
    splits = [0.0]
    startpos = splits[0]
    breakpos = splits[0]
 
    for i in range (1, len(alltimes)):
-      middlepos = leadin + (alltimes[i] + alltimes[i-1]) * step / 2
-      if middlepos - startpos > pwidth - 2 * pborder:
+      middlepos = leadin + (alltimes[i] + alltimes[i-1] - 2 * start) * step / 2
+      # without a wide gap since the last break the strip grows too long
+      if middlepos - startpos > maxwidth and breakpos > startpos:
          splits.append (breakpos)
          startpos = breakpos
 
       if (alltimes[i] - alltimes[i-1]) * step > radius * 4:
          breakpos = middlepos
 
+   # the lead-out may not fit either
+   if length - startpos > maxwidth and breakpos > startpos:
+      splits.append (breakpos)
    splits.append (length)
+   return splits
+
+
+def split_optimal (alltimes, step, radius, leadin, length, maxwidth):
+   # Fewest strips by dynamic programming over the gaps. Any gap that
+   # clears the holes may take a break; among layouts with as few strips,
+   # the one with the fewest breaks in gaps narrower than 4 radii wins,
+   # then the one whose narrowest break is widest. The best reachable
+   # break is a sliding window minimum, so this is linear.
+   start = alltimes[0]
+   cand = [(0.0, float ("inf"))]
+   for a, b in zip (alltimes, alltimes[1:]):
+      if (b - a) * step > radius * 2:
+         cand.append ((leadin + (a + b - 2 * start) * step / 2, (b - a) * step))
+   cand.append ((length, float ("inf")))
+
+   # key: (strips, narrow breaks, -narrowest gap), smaller is better
+   keys = [(0, 0, -float ("inf"))]
+   prev = [None]
+   window = collections.deque ([0])
+   for j in range (1, len (cand)):
+      pos, gap = cand[j]
+      while window and pos - cand[window[0]][0] > maxwidth:
+         window.popleft ()
+      # nothing in reach: the strip has to be too long
+      i = window[0] if window else j - 1
+      strips, narrow, worst = keys[i]
+      keys.append ((strips + 1, narrow + (gap <= radius * 4), max (worst, -gap)))
+      prev.append (i)
+      while window and keys[window[-1]] >= keys[j]:
+         window.pop ()
+      window.append (j)
+
+   splits = []
+   j = len (cand) - 1
+   while j is not None:
+      splits.append (cand[j][0])
+      j = prev[j]
+   return splits[::-1]
+
+
+split_methods = {
+   "greedy"  : split_greedy,
+   "optimal" : split_optimal,
+}
+
+
+def layout_splits (model, notelist, mindelta, maxwidth, split="optimal"):
+   # strip boundaries along the band in mm
+   radius  = model.diameter / 2
+   step    = model.mm_per_tick (mindelta)
+   leadin  = 20.0
+   leadout = 20.0
+
+   alltimes = sorted (set ().union (*notelist))
+   if not alltimes:
+      # no holes, one empty strip as long as strip_length says
+      return [0.0, leadin + leadout]
+   start   = alltimes[0]
+   end     = alltimes[-1]
+   length  = int (end - start) * step + radius * 2 + leadin + leadout
+
+   return split_methods[split] (alltimes, step, radius, leadin, length, maxwidth)
+
+
+def splits_fit (splits, maxwidth):
+   # whether every strip fits on the page
+   return all (b - a <= maxwidth for a, b in zip (splits, splits[1:]))
+
+
+def layout_holes (model, notelist, mindelta, maxwidth, split="optimal"):
+   # Positions along the band in mm: the strip boundaries and an iterator
+   # over the holes as (x, y) sorted by x. Linear in the number of holes,
+   # apart from the merge over the tines.
+   offset  = model.offset
+   dist    = model.distance
+   step    = model.mm_per_tick (mindelta)
+   leadin  = 20.0
+   start   = min ((tine[0] for tine in notelist if tine), default=0)
+
+   splits = layout_splits (model, notelist, mindelta, maxwidth, split)
+
+   # every tine is sorted already, merge them lazily instead of sorting
+   def tine_holes (i):
+      y = i * dist + offset
+      return ((leadin + (n - start) * step, y) for n in notelist[i])
+   holes = heapq.merge (*map (tine_holes, range (len (notelist))))
+
+   return splits, holes
+
+
+# Paper size in millimeters.
+paper = {
+   # This is 2x A4 in  millimeters.
+   # "width"  : 420.0,
+   # "height" : 297.0,
+
+   # "width"  : 700.0 - 20,
+   # "height" : 500.0 - 20,
+
+   # US Letter:
+   # 215.9mm x 279.4mm
+   #"width"  : 279.4,
+   #"height" : 215.9,
+
+   # US Letter with a 10mm border
+   "width"  : 269.4,
+   "height" : 205.9,
+
+   # US Legal
+   #"width"  : 356,
+   #"height" : 215.9,
+
+   # US Legal 2
+   #"width"  : 336,
+   #"height" : 195.9,
+
+   #"height" : 228.6,
+   #"width"  : 304.8,
+
+   "border" : 3,
+   #"border" : 10    - 8,
+}
+
+
+def layout_strips (model, notelist, mindelta, is_pdf, split="optimal"):
+   # Place the strips on the paper. Returns the page height and an
+   # iterator over the strips, (y0, x0, x1, holes, new_page): x0/x1 are
+   # band positions, holes the (x, y) band positions of its holes and
+   # new_page tells whether the next strip goes onto a new page. The
+   # strips are taken from the merged holes as they are needed, only
+   # the holes of one strip are held at a time.
+   pwidth  = paper["width"]
+   pheight = paper["height"]
+   pborder = paper["border"]
+   height  = model.height
+
+   splits, holes = layout_holes (model, notelist, mindelta, pwidth - 2 * pborder,
+                                 split)
+
+   if not is_pdf:
+      # svg has no pages, everything goes on one long page
+      pheight = len (splits) * (height + pborder) - height + 1
+
+   def strips ():
+      y0 = pborder
+      hole = next (holes, None)
+      for x0, x1 in zip (splits, splits[1:]):
+         strip = [y0, x0, x1, [], False]
+         while hole is not None and hole[0] < x1:
+            strip[3].append (hole)
+            hole = next (holes, None)
+         y0 = y0 + height + pborder
+         if y0 + height + pborder > pheight:
+            y0 = pborder
+            strip[4] = True
+         yield tuple (strip)
 
-   holes = [(leadin + (n - start) * step, i * dist + offset) for i in range (len (notelist)) for n in notelist[i]]
-   holes.sort ()
+   return pheight, strips ()
+
+
+def output_file (model, filename, is_pdf, notelist, mindelta, split="optimal"):
+   try:
+      import cairo
+   except ImportError:
+      raise Exception("pdf/svg output needs pycairo, --render=direct works without it")
+
+   pwidth  = paper["width"]
+   pborder = paper["border"]
+   height  = model.height
+   offset  = model.offset
+   radius  = model.diameter / 2
+   dist    = model.distance
+
+   pheight, strips = layout_strips (model, notelist, mindelta, is_pdf, split)
 
    if is_pdf:
       surface = cairo.PDFSurface (filename,
@@ -164,7 +480,6 @@ def output_file (model, filename, is_pdf, notelist, mindelta):
                                   pheight / 25.4 * 72)
    else:
       # cairo svg cannot deal with multiple pages
-      pheight = len (splits) * (height + pborder) - height + 1
       surface = cairo.SVGSurface (filename,
                                   pwidth / 25.4 * 72,
                                   pheight / 25.4 * 72)
@@ -186,12 +501,18 @@ def output_file (model, filename, is_pdf, notelist, mindelta):
    cr.close_path ()
    cr.fill ()
 
-   y0 = pborder
-   y1 = y0 + height
+   # build the hole path once and stamp it, no arc math per hole
+   cr.new_sub_path ()
+   cr.arc (0, 0, radius, 0.0*math.pi, 0.5*math.pi)
+   cr.arc (0, 0, radius, 0.5*math.pi, 1.0*math.pi)
+   cr.arc (0, 0, radius, 1.0*math.pi, 1.5*math.pi)
+   cr.arc (0, 0, radius, 1.5*math.pi, 2.0*math.pi)
+   cr.close_path ()
+   hole = cr.copy_path ()
+   cr.new_path ()
 
-   x0 = splits.pop (0)
-   while splits:
-      x1 = splits.pop (0)
+   for y0, x0, x1, holes, new_page in strips:
+      y1 = y0 + height
       cr.set_source_rgb (0, 0, 1)
       cr.set_line_width (0.4)
       # cr.rectangle (pborder, y0, x1 - x0, y1 - y0)
@@ -203,12 +524,12 @@ def output_file (model, filename, is_pdf, notelist, mindelta):
 
       if 0:
          cr.set_source_rgb (0.7, 0.7, 0.7)
-         for i in range (len (model["notes"])):
+         for i in range (len (model.notes)):
             y = y0 + offset + i * dist
             cr.move_to (pborder, y)
             cr.line_to (pborder + x1 - x0, y)
-            if model["notes"][i] % 12 in [0, 2, 4, 5, 7, 9, 11]:
-               if model["notes"][i] % 12 == 0:
+            if model.notes[i] % 12 in [0, 2, 4, 5, 7, 9, 11]:
+               if model.notes[i] % 12 == 0:
                   cr.set_line_width (0.4)
                else:
                   cr.set_line_width (0.2)
@@ -221,14 +542,12 @@ def output_file (model, filename, is_pdf, notelist, mindelta):
       cr.set_dash ([], 0)
       cr.set_line_width (0.4)
       border_end = pborder;
-      while holes and holes[0][0] < x1:
-         x, y = holes.pop (0)
-         cr.new_sub_path ()
-         cr.arc (x - x0 + pborder, y + y0, radius, 0.0*math.pi, 0.5*math.pi)
-         cr.arc (x - x0 + pborder, y + y0, radius, 0.5*math.pi, 1.0*math.pi)
-         cr.arc (x - x0 + pborder, y + y0, radius, 1.0*math.pi, 1.5*math.pi)
-         cr.arc (x - x0 + pborder, y + y0, radius, 1.5*math.pi, 2.0*math.pi)
-         cr.close_path ()
+      for x, y in holes:
+         # the path is not part of the saved state, only the translation
+         cr.save ()
+         cr.translate (x - x0 + pborder, y + y0)
+         cr.append_path (hole)
+         cr.restore ()
          if x - x0 + pborder - border_end >= 50:
             cr.move_to (border_end, y0)
             cr.line_to (x - x0 + pborder, y0)
@@ -247,66 +566,811 @@ def output_file (model, filename, is_pdf, notelist, mindelta):
       cr.set_source_rgb (1, 0, 0)
       cr.stroke ()
 
-      x0 = x1
-      y0 = y1 + pborder
-      if y0 + height + pborder > pheight:
-         y0 = pborder
+      if new_page:
          cr.show_page ()
-      y1 = y0 + height
 
    del cr
    del surface
 
 
-def output_midi (model, filename, notelist, mindelta):
-   # fix up notes to correspond to midi notes
-   notes = [ n + model["lowest"] for n in model["notes"] ]
+# a hole of radius 1 around the origin as four bezier curves, like
+# cairo draws the arcs
+kappa = 4.0 / 3 * (math.sqrt (2) - 1)
+hole_curves = [(1, kappa, kappa, 1, 0, 1), (-kappa, 1, -1, kappa, -1, 0),
+               (-1, -kappa, -kappa, -1, 0, -1), (kappa, -1, 1, -kappa, 1, 0)]
+
+
+def render_strips (is_pdf, strips, height, radius, pborder, arrow):
+   # Draw strips (as from layout_strips) without cairo: a PDF content
+   # stream (zlib compressed) or SVG elements. Holes are stamped from one
+   # precomputed path. Runs in worker processes, one call per page.
+   out = []
+   if is_pdf:
+      # millimeters, the origin at the bottom left like the cairo version
+      out.append ("2.83464 0 0 2.83464 0 0 cm 0 J 0 j\n")
+      hole = "%.4f 0 m " % radius + " ".join ("%.4f %.4f %.4f %.4f %.4f %.4f c" %
+                                              tuple (radius * v for v in c)
+                                              for c in hole_curves) + " h S Q\n"
+      line = "%.3f %.3f m %.3f %.3f l\n"
+      if arrow:
+         out.append ("0.2 w 4 5 m 7 7 l 7 5.7 l 17 5.7 l 17 4.3 l 7 4.3 l 7 3 l h f\n")
+   else:
+      hole = "<circle cx=\"%%.3f\" cy=\"%%.3f\" r=\"%g\"/>\n" % radius
+      line = "<path d=\"M%.3f %.3fL%.3f %.3f\"/>\n"
+      if arrow:
+         out.append ("<path d=\"M4 5L7 7L7 5.7L17 5.7L17 4.3L7 4.3L7 3Z\" fill=\"black\"/>\n")
+
+   for y0, x0, x1, holes, new_page in strips:
+      y1 = y0 + height
+      if is_pdf:
+         out.append ("0 0 1 RG 0.4 w\n")
+      else:
+         out.append ("<g stroke=\"blue\">\n")
+      out.append (line % (pborder, y0, pborder, y1))
+      out.append (line % (pborder + x1 - x0, y0, pborder + x1 - x0, y1))
+      if is_pdf:
+         out.append ("S 1 0 0 RG\n")
+      else:
+         out.append ("</g>\n<g stroke=\"red\">\n")
+
+      border_end = pborder;
+      for x, y in holes:
+         if is_pdf:
+            out.append ("q 1 0 0 1 %.3f %.3f cm " % (x - x0 + pborder, y + y0) + hole)
+         else:
+            out.append (hole % (x - x0 + pborder, y + y0))
+         if x - x0 + pborder - border_end >= 50:
+            out.append (line % (border_end, y0, x - x0 + pborder, y0))
+            out.append (line % (border_end, y1, x - x0 + pborder, y1))
+            if is_pdf:
+               out.append ("S\n")
+            border_end = x - x0 + pborder
+
+      if border_end < x1:
+         out.append (line % (border_end, y0, x1 - x0 + pborder, y0))
+         out.append (line % (border_end, y1, x1 - x0 + pborder, y1))
+         if is_pdf:
+            out.append ("S\n")
+      if not is_pdf:
+         out.append ("</g>\n")
+
+   data = "".join (out).encode ("ascii")
+   return zlib.compress (data) if is_pdf else data
+
+
+def output_file_direct (model, filename, is_pdf, notelist, mindelta, jobs=1,
+                        split="optimal"):
+   # PDF/SVG output written directly, pages rendered in parallel. Draws the
+   # same as output_file, but every hole is a stamped copy of one path.
+   pwidth  = paper["width"]
+   pborder = paper["border"]
+   height  = model.height
+   radius  = model.diameter / 2
+
+   pheight, strips = layout_strips (model, notelist, mindelta, is_pdf, split)
+   # the pages are all rendered before writing anyway
+   strips = list (strips)
+
+   # pages for the pdf, a few chunks per worker for the single svg page
+   pages = [[]]
+   for strip in strips:
+      pages[-1].append (strip)
+      if strip[4] or (not is_pdf and len (pages[-1]) * (jobs or 1) * 4 >= len (strips)):
+         pages.append ([])
+   pages = [p for p in pages if p]
+
+   args = [(is_pdf, p, height, radius, pborder, i == 0) for i, p in enumerate (pages)]
+   if jobs == 1 or len (pages) == 1:
+      contents = [render_strips (*a) for a in args]
+   else:
+      import concurrent.futures
+      with concurrent.futures.ProcessPoolExecutor (max_workers=jobs) as pool:
+         contents = list (pool.map (render_strips, *zip (*args)))
+
+   with open (filename, "wb") as f:
+      if is_pdf:
+         write_pdf (f, contents, pwidth / 25.4 * 72, pheight / 25.4 * 72)
+      else:
+         f.write (('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<svg xmlns="http://www.w3.org/2000/svg" width="%gmm" height="%gmm" viewBox="0 0 %g %g">\n'
+                   '<g transform="matrix(1 0 0 -1 0 %g)" fill="none" stroke-width="0.4">\n'
+                   % (pwidth, pheight, pwidth, pheight, pheight)).encode ("ascii"))
+         for c in contents:
+            f.write (c)
+         f.write (b"</g>\n</svg>\n")
+
+
+def write_pdf (f, contents, width, height):
+   # a minimal PDF: catalog, page tree and one page per content stream
+   offsets = []
+   pos = [0]
+   def obj (data):
+      offsets.append (pos[0])
+      data = ("%d 0 obj\n" % len (offsets)).encode ("ascii") + data + b"\nendobj\n"
+      f.write (data)
+      pos[0] += len (data)
+
+   header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+   f.write (header)
+   pos[0] = len (header)
+
+   kids = " ".join ("%d 0 R" % (3 + 2 * i) for i in range (len (contents)))
+   obj (b"<< /Type /Catalog /Pages 2 0 R >>")
+   obj (("<< /Type /Pages /Kids [%s] /Count %d /MediaBox [0 0 %.3f %.3f] >>"
+         % (kids, len (contents), width, height)).encode ("ascii"))
+   for i, c in enumerate (contents):
+      obj (("<< /Type /Page /Parent 2 0 R /Resources << >> /Contents %d 0 R >>"
+            % (4 + 2 * i)).encode ("ascii"))
+      obj (("<< /Length %d /Filter /FlateDecode >>\nstream\n" % len (c)).encode ("ascii")
+           + c + b"\nendstream")
+
+   xref = pos[0]
+   f.write (("xref\n0 %d\n0000000000 65535 f \n" % (len (offsets) + 1)).encode ("ascii"))
+   for o in offsets:
+      f.write (("%010d 00000 n \n" % o).encode ("ascii"))
+   f.write (("trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+             % (len (offsets) + 1, xref)).encode ("ascii"))
+
+
+# The laser cutter: speeds in mm/min, power is the S value for M4.
+laser = {
+   "feed"  : 600,
+   "rapid" : 3000,
+   "power" : 1000,
+}
+
+
+def order_holes (holes, pos, window=8):
+   # Cut order for the holes (x, y) of a strip, starting at pos. The
+   # columns (holes at the same time) are cut serpentine, each one from the
+   # end nearer to the last hole, then a 2-opt over a small window removes
+   # the remaining detours. Linear in the number of holes.
+   columns = [list (c) for x, c in itertools.groupby (holes, key=operator.itemgetter (0))]
+   if columns and abs (columns[-1][0][0] - pos[0]) < abs (columns[0][0][0] - pos[0]):
+      columns.reverse ()
+
+   path = [pos]
+   for c in columns:
+      if abs (c[-1][1] - path[-1][1]) < abs (c[0][1] - path[-1][1]):
+         c.reverse ()
+      path += c
+
+   dist = math.dist
+   for i in range (len (path) - 2):
+      for j in range (i + 2, min (i + window, len (path))):
+         a, b, c = path[i], path[i+1], path[j]
+         if j + 1 < len (path):
+            d = path[j+1]
+            gain = dist (a, b) + dist (c, d) - dist (a, c) - dist (b, d)
+         else:
+            gain = dist (a, b) - dist (a, c)
+         if gain > 1e-9:
+            path[i+1:j+1] = path[i+1:j+1][::-1]
+   return path[1:]
+
+
+def output_laser (model, filename, is_gcode, notelist, mindelta, split="optimal"):
+   # G-code (sheet after sheet, pausing in between) or DXF (one long sheet
+   # like the svg) for the laser cutter. On every sheet the holes are cut
+   # first, in an order that keeps the travel short, then the strip
+   # outlines. Written strip by strip as they are laid out, only the
+   # holes of one strip are in memory. Returns the cut and travel length
+   # in mm, the travel when cutting in time order and the estimated time
+   # in seconds.
+   pborder = paper["border"]
+   height  = model.height
+   radius  = model.diameter / 2
+
+   pheight, strips = layout_strips (model, notelist, mindelta, is_gcode, split)
+
+   if is_gcode:
+      hole = "G0 X%%.3f Y%%.3f\nG2 X%%.3f Y%%.3f I%.3f J0\n" % -radius
+      move = "G0 X%.3f Y%.3f\n"
+      line = "G1 X%.3f Y%.3f\n"
+   else:
+      hole = "0\nCIRCLE\n8\nholes\n62\n1\n10\n%%.3f\n20\n%%.3f\n40\n%g\n" % radius
+      line = "0\nLINE\n8\noutlines\n62\n5\n10\n%.3f\n20\n%.3f\n11\n%.3f\n21\n%.3f\n"
+
+   cut = travel = in_order = 0.0
+   pos = last = (0.0, 0.0)
+   outlines = []
+   with open (filename, "w") as f:
+      if is_gcode:
+         f.write ("G21\nG90\nM4 S%d\nF%g\n" % (laser["power"], laser["feed"]))
+      else:
+         f.write ("0\nSECTION\n2\nENTITIES\n")
+
+      # one strip ahead, to know the last one
+      strips = iter (strips)
+      strip = next (strips, None)
+      while strip:
+         y0, x0, x1, holes, new_page = strip
+         strip = next (strips, None)
+         # the hole positions on the sheet, the order starting at the
+         # right of the circle as G2 cuts it
+         points = [(x - x0 + pborder + radius, y + y0) for x, y in holes]
+         for p in points:
+            in_order += math.dist (last, p)
+            last = p
+         out = []
+         for p in order_holes (points, pos):
+            travel += math.dist (pos, p)
+            pos = p
+            if is_gcode:
+               out.append (hole % (p + p))
+            else:
+               out.append (hole % (p[0] - radius, p[1]))
+         cut += len (points) * 2 * math.pi * radius
+         f.write ("".join (out))
+
+         outlines.append ((y0, x1 - x0))
+         if not new_page and strip:
+            continue
+
+         # the outlines, each from the corner nearest to the head
+         out = []
+         for y0, length in reversed (outlines):
+            corners = [(pborder, y0), (pborder + length, y0),
+                       (pborder + length, y0 + height), (pborder, y0 + height)]
+            i = min (range (4), key=lambda i: math.dist (pos, corners[i]))
+            corners = corners[i:] + corners[:i + 1]
+            travel += math.dist (pos, corners[0])
+            in_order += math.dist (last, corners[0])
+            cut += 2 * (length + height)
+            if is_gcode:
+               out.append (move % corners[0])
+            for a, b in zip (corners, corners[1:]):
+               out.append (line % (b if is_gcode else a + b))
+            pos = last = corners[0]
+         outlines = []
+         if is_gcode and strip:
+            # wait for the next sheet
+            out.append ("M5\nM0\nM4 S%d\n" % laser["power"])
+         f.write ("".join (out))
+
+      if is_gcode:
+         f.write ("M5\nG0 X0 Y0\nM2\n")
+      else:
+         f.write ("0\nENDSEC\n0\nEOF\n")
+
+   return { "cut"        : cut,
+            "travel"     : travel,
+            "time_order" : in_order,
+            "time"       : (cut / laser["feed"] + travel / laser["rapid"]) * 60 }
+
+# Raster previews: pixels per mm of a preview and of the thumbnails on a
+# contact sheet, and the palette: paper, strip outline, hole, tine guide,
+# guide of the C tines.
+preview = {
+   "scale"     : 2.0,
+   "thumbnail" : 0.5,
+   "colors"    : [(255, 255, 255), (0, 0, 255), (255, 0, 0),
+                  (210, 210, 210), (150, 150, 150)],
+}
+
+
+def disc_spans (radius):
+   # a filled disc as (row offset, half width) spans, at least one pixel
+   r = max (int (radius), 0)
+   return [(dy, int (math.sqrt (max (radius * radius - dy * dy, 0))))
+           for dy in range (-r, r + 1)]
+
+
+def stamp_discs (pixels, width, centers, spans, color):
+   # centers are offsets into pixels, one slice assignment per span
+   runs = dict ((w, bytes ([color]) * (2 * w + 1)) for dy, w in spans)
+   rows = [(dy * width - w, dy * width + w + 1, runs[w]) for dy, w in spans]
+   for c in centers:
+      for start, end, run in rows:
+         pixels[c + start:c + end] = run
+
+
+def stamp_discs_numpy (pixels, width, centers, spans, color):
+   # the same with the offsets of all disc pixels added to all centers
+   import numpy
+   offsets = numpy.array ([dy * width + dx for dy, w in spans
+                           for dx in range (-w, w + 1)])
+   image = numpy.frombuffer (pixels, dtype=numpy.uint8)
+   image[(numpy.array (centers)[:, None] + offsets[None, :]).ravel ()] = color
+
+
+def render_preview (model, notelist, mindelta, scale, guides=False,
+                    split="optimal", length=None):
+   # The strips as laid out for svg, rasterized with scale pixels per mm
+   # and the y axis up like in the pdf. length cuts the image off after
+   # the strips that fit (in mm). Returns (width, height, pixels) with a
+   # byte per pixel indexing preview["colors"].
+   pborder = paper["border"]
+   height  = model.height
+   offset  = model.offset
+   dist    = model.distance
+
+   pheight, strips = layout_strips (model, notelist, mindelta, False, split)
+   if length is not None:
+      # on the single svg page the strips go down in order
+      pheight = min (pheight, length)
+      strips = itertools.takewhile (lambda s: s[0] + height + pborder <= pheight,
+                                    strips)
+
+   width = int (paper["width"] * scale) + 1
+   rows = int (pheight * scale) + 1
+   pixels = bytearray (width * rows)
+
+   def at (x, y):
+      return (rows - 1 - int (y * scale + 0.5)) * width + int (x * scale + 0.5)
+
+   def hline (x0, x1, y, color):
+      start = at (x0, y)
+      pixels[start:start + int ((x1 - x0) * scale + 0.5) + 1] = \
+         bytes ([color]) * (int ((x1 - x0) * scale + 0.5) + 1)
+
+   def vline (x, y0, y1, color):
+      # from the top row down
+      start, end = at (x, y1), at (x, y0)
+      pixels[start:end + 1:width] = bytes ([color]) * ((end - start) // width + 1)
+
+   centers = []
+   for y0, x0, x1, holes, new_page in strips:
+      y1 = y0 + height
+      if guides:
+         for i in range (len (model.notes)):
+            hline (pborder, pborder + x1 - x0, y0 + offset + i * dist,
+                   4 if model.notes[i] % 12 == 0 else 3)
+      hline (pborder, pborder + x1 - x0, y0, 1)
+      hline (pborder, pborder + x1 - x0, y1, 1)
+      vline (pborder, y0, y1, 1)
+      vline (pborder + x1 - x0, y0, y1, 1)
+      centers += [at (x - x0 + pborder, y + y0) for x, y in holes]
+
+   try:
+      import numpy
+      stamp = stamp_discs_numpy
+   except ImportError:
+      stamp = stamp_discs
+   if centers:
+      stamp (pixels, width, centers, disc_spans (model.diameter / 2 * scale), 2)
+
+   return width, rows, pixels
+
+
+def write_png (f, width, height, pixels, colors, idat_size=1 << 16):
+   # an 8 bit palette PNG, every row unfiltered. The rows go through the
+   # compressor as they are, the compressed data is written in IDAT
+   # chunks of about idat_size bytes, so the raster is never copied.
+   def chunk (kind, data):
+      f.write (struct.pack (">I", len (data)) + kind + data +
+               struct.pack (">I", zlib.crc32 (kind + data)))
+
+   f.write (b"\x89PNG\r\n\x1a\n")
+   chunk (b"IHDR", struct.pack (">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+   chunk (b"PLTE", bytes (c for color in colors for c in color))
+
+   compressor = zlib.compressobj (6)
+   rows = memoryview (pixels)
+   pending = bytearray ()
+   for r in range (height):
+      pending += compressor.compress (b"\0")
+      pending += compressor.compress (rows[r * width:(r + 1) * width])
+      if len (pending) >= idat_size:
+         chunk (b"IDAT", bytes (pending))
+         pending = bytearray ()
+   pending += compressor.flush ()
+   chunk (b"IDAT", bytes (pending))
+   chunk (b"IEND", b"")
+
+
+def output_preview (model, filename, notelist, mindelta, guides=False,
+                    split="optimal"):
+   width, height, pixels = render_preview (model, notelist, mindelta,
+                                           preview["scale"], guides, split)
+   with open (filename, "wb") as f:
+      write_png (f, width, height, pixels, preview["colors"])
+
+
+def write_contact_sheet (filename, thumbnails, columns=None):
+   # thumbnails (width, height, pixels) in a grid, None leaves a tile empty
+   gap = 4
+   columns = columns or max (1, math.ceil (math.sqrt (len (thumbnails))))
+   tiles = [t for t in thumbnails if t]
+   tw = max ([t[0] for t in tiles], default=1)
+   th = max ([t[1] for t in tiles], default=1)
+   lines = -(-len (thumbnails) // columns)
+   width = columns * (tw + gap) + gap
+   height = lines * (th + gap) + gap
+   # the gaps in the guide color
+   pixels = bytearray ([3]) * (width * height)
+   for i, t in enumerate (thumbnails):
+      left = gap + (i % columns) * (tw + gap)
+      top = gap + (i // columns) * (th + gap)
+      w, h, tile = t or (tw, th, bytes (tw * th))
+      for r in range (h):
+         start = (top + r) * width + left
+         pixels[start:start + w] = tile[r * w:(r + 1) * w]
+   with open (filename, "wb") as f:
+      write_png (f, width, height, pixels, preview["colors"])
+
+
+def strip_length (model, notelist, mindelta):
+   # length of the paper strip in mm, as laid out by output_file
+   radius  = model.diameter / 2
+   step    = model.mm_per_tick (mindelta)
+   leadin  = 20.0
+   leadout = 20.0
+   ticks = [t for tine in notelist if tine for t in (tine[0], tine[-1])]
+   if not ticks:
+      return leadin + leadout
+   return int (max (ticks) - min (ticks)) * step + radius * 2 + leadin + leadout
+
+
+def paper_usage (model, notelist, mindelta, split="optimal"):
+   # strips and pdf pages as laid out by output_file, the length of the
+   # cuts at the strip ends in mm and whether all strips fit on the page
+   pheight = paper["height"]
+   pborder = paper["border"]
+   height  = model.height
+   maxwidth = paper["width"] - 2 * pborder
+
+   splits = layout_splits (model, notelist, mindelta, maxwidth, split)
+   strips = len (splits) - 1
+
+   per_page = 1
+   while pborder + per_page * (height + pborder) + height + pborder <= pheight:
+      per_page += 1
+
+   return { "strips" : strips,
+            "pages"  : -(-strips // per_page),
+            "cuts"   : strips * 2 * height,
+            "fits"   : splits_fit (splits, maxwidth) }
+
 
+# microseconds per quarter note until the first tempo change
+default_tempo = 500000
+
+def output_midi (model, filename, notelist, mindelta, timediv,
+                 tempo=default_tempo):
+   # The band as a midi file, the ticks are on the timeline at tempo
+   # (microseconds per quarter note, see TempoMap).
+   notes = model.pitches
+
+   # One int per event, ordered like (time, note, on). Every tine is
+   # sorted already, so the sort only merges these runs.
    events = []
    for i in range (len (notelist)):
-      events += [(t, notes[i], 1) for t in notelist[i]]
+      on = notes[i] << 1 | 1
+      events += [t << 9 | on for t in notelist[i]]
       # add events to shut off the notes
-      events += [(t+mindelta, notes[i], 0) for t in notelist[i]]
+      off = notes[i] << 1
+      events += [(t + mindelta) << 9 | off for t in notelist[i]]
+
+   events.sort ()
 
-   events.sort()
+   # at most 4 bytes delta time and 3 bytes event each
+   eventdata = bytearray (10 + 7 * len (events) + 4)
+   # tempo and program select
+   eventdata[0:7] = (0x00, 0xff, 0x51, 0x03) + tuple (tempo.to_bytes (3, "big"))
+   eventdata[7:10] = (0x00, 0xc0, model.program)
+   pos = 10
 
    last_time = 0
-   eventdata = bytearray()
-   # program select
-   eventdata += bytearray([0x00 , 0xc0 , model["program"]])
-
-   for t, i, on in events:
-      dt = t - last_time
-      if (dt >> 21):
-         eventdata += bytearray([ (0x80 | ((dt >> 21) & 0x7f)) ])
-      if (dt >> 14):
-         eventdata += bytearray([  (0x80 | ((dt >> 14) & 0x7f))  ])
+   for e in events:
+      dt = (e >> 9) - last_time
+      last_time += dt
       if (dt >> 7):
-         eventdata += bytearray([  (0x80 | ((dt >> 7) & 0x7f))  ])
+         if (dt >> 21):
+            eventdata[pos] = 0x80 | ((dt >> 21) & 0x7f)
+            pos += 1
+         if (dt >> 14):
+            eventdata[pos] = 0x80 | ((dt >> 14) & 0x7f)
+            pos += 1
+         eventdata[pos] = 0x80 | ((dt >> 7) & 0x7f)
+         pos += 1
+
+      eventdata[pos] = dt & 0x7f
+      eventdata[pos + 1] = 0x90 if e & 1 else 0x80
+      eventdata[pos + 2] = (e >> 1) & 0xff
+      eventdata[pos + 3] = 127
+      pos += 4
+
+   eventdata[pos:pos + 4] = (0x00, 0xFF, 0x2F, 0x00)
+   pos += 4
+
+   with open (filename, 'wb') as outfile:
+      outfile.write (b"MThd" + struct.pack (">ihhh", 6, 0, 1, timediv))
+      outfile.write (b"MTrk" + struct.pack (">i", pos))
+      outfile.write (memoryview (eventdata)[:pos])
+
+
+# The --wav simulation: sample rate, seconds a tine rings at most and its
+# partials as (frequency ratio, amplitude, decay time in seconds). A comb
+# tine is a clamped bar, its overtones are not harmonic.
+synth = {
+   "rate"     : 44100,
+   "length"   : 2.0,
+   "partials" : [(1.0, 1.0, 1.0), (2.0, 0.15, 0.4),
+                 (5.93, 0.25, 0.12), (16.6, 0.08, 0.04)],
+}
 
-      eventdata += bytearray([  (0x00 | ((dt >> 0) & 0x7f)) ])
-      if on:
-         eventdata += bytearray([ 0x90, i , 127 ])
+# tine sounds by midi note and synth settings, see tine_sample
+tine_samples = {}
+
+def tine_sample (note, numpy):
+   rate = synth["rate"]
+   key = (note, rate, synth["length"], tuple (synth["partials"]))
+   if key not in tine_samples:
+      f = 440.0 * 2 ** ((note - 69) / 12.0)
+      t = numpy.arange (int (rate * synth["length"])) / rate
+      sample = numpy.zeros (len (t))
+      for ratio, amplitude, decay in synth["partials"]:
+         if f * ratio < rate / 2:
+            sample += amplitude * numpy.exp (-t / decay) * numpy.sin (2 * math.pi * f * ratio * t)
+      # 2ms attack against the click
+      attack = int (rate * 0.002)
+      sample[:attack] *= numpy.linspace (0, 1, attack, endpoint=False)
+      tine_samples[key] = sample.astype (numpy.float32)
+   return tine_samples[key]
+
+
+def output_wav (model, filename, notelist, timediv, tempo=default_tempo):
+   # The band as the music box would sound, a 16 bit mono wav file. Every
+   # hole adds the cached sound of its tine, cut off when the tine is
+   # plucked again. Returns the length in seconds.
+   try:
+      import numpy
+   except ImportError:
+      raise Exception("wav output needs numpy")
+   import wave
+
+   rate = synth["rate"]
+   tick = TempoMap (timediv, [(0, tempo)]).seconds (1) * rate
+   notes = model.pitches
+
+   end = max ((tine[-1] for tine in notelist if tine), default=0)
+   out = numpy.zeros (int (end * tick) + int (rate * synth["length"]) + 1,
+                      dtype=numpy.float32)
+   for i in range (len (notelist)):
+      if not notelist[i]:
+         continue
+      sample = tine_sample (notes[i], numpy)
+      starts = (numpy.array (notelist[i]) * tick + 0.5).astype (numpy.int64)
+      ends = numpy.minimum (numpy.append (starts[1:], len (out)), starts + len (sample))
+      # one vector add per hole, faster than numpy.add.at over index arrays
+      for start, stop in zip (starts.tolist (), ends.tolist ()):
+         out[start:stop] += sample[:stop - start]
+
+   peak = float (numpy.abs (out).max ())
+   if peak > 0:
+      out *= 0.9 / peak
+   with wave.open (filename, "wb") as w:
+      w.setnchannels (1)
+      w.setsampwidth (2)
+      w.setframerate (rate)
+      w.writeframes ((out * 32767).astype ("<i2").tobytes ())
+   return len (out) / rate
+
+
+def note_histogram (notes):
+   # count the notes per pitch, works on any iterable of notes (e.g.
+   # MidiImporter.iter_notes) without keeping them around
+   notecount = [0] * 128
+   for n in notes:
+      notecount[n.note] += 1
+   return notecount
+
+
+
+def weighted_histogram (notes, durations=False, track_weights=None):
+   # notes are (note, duration, track) tuples
+   notecount = [0] * 128
+   for n, d, t in notes:
+      w = max (d, 1) if durations else 1
+      if track_weights:
+         w *= track_weights.get (t, 1)
+      notecount[n] += w
+   return notecount
+
+
+def highest_track (notes):
+   # the track with the highest average pitch, a guess for the melody.
+   # notes are (note, track) tuples
+   sums = collections.Counter ()
+   counts = collections.Counter ()
+   for n, t in notes:
+      sums[t] += n
+      counts[t] += 1
+   if not counts:
+      return None
+   return max (counts, key=lambda t: (sums[t] / counts[t], -t))
+
+
+def band_losses (band_sources, model):
+   # (dropped, merged): notes without a tine at all and notes that
+   # coincide with another note on their tine after octave folding.
+   # band_sources are (pitch index, transpose) pairs, see
+   # PianoRoll.band_sources ()
+   dropped = 0
+   sources = [[] for i in range (len (model.notes))]
+   for index, transpose in band_sources:
+      folds = model.fold_table (transpose)
+      for p in range (128):
+         if index[p]:
+            if not folds[p]:
+               dropped += len (index[p])
+            for tine in folds[p]:
+               sources[tine].append (index[p])
+
+   merged = 0
+   for s in sources:
+      if len (s) > 1:
+         merged += sum (map (len, s)) - len (set ().union (*s))
+   return dropped, merged
+
+
+def recovery_ticks (model, mindelta):
+   # The closest two holes on one tine may come, in ticks. A tine needs
+   # model.recovery mm to sound again: given, from the recovery_time and
+   # the speed, or by default one step, the fastest repetition of a pitch
+   # is laid out one step apart and folding octaves onto a tine must not
+   # make it any faster.
+   return max (1, math.ceil (model.recovery * mindelta / model.step - 1e-9))
+
+
+def tine_collisions (band, mingap):
+   # (tine, tick, previous tick) for every hole closer than mingap ticks
+   # to the one before on its tine
+   found = []
+   for tine, ticks in enumerate (band):
+      gaps = map (operator.sub, ticks[1:], ticks[:-1])
+      for k in itertools.compress (range (1, len (ticks)), map (mingap.__gt__, gaps)):
+         found.append ((tine, ticks[k], ticks[k - 1]))
+   return found
+
+
+def repair_band (band_sources, model, mindelta):
+   # The band with collisions resolved, and a report. Every tine keeps
+   # the more important of two notes too close to each other: a note at
+   # its own pitch before one folded from another octave, then the higher
+   # note. The other one is moved to another tine of its pitch class if
+   # that one is free there (refolded), else shifted by up to one step
+   # (nudged), else dropped. A note merged with another one on the same
+   # tick is only refolded (unmerged), otherwise it stays merged as
+   # without repair. Every tine is walked once in tick order.
+   mingap = recovery_ticks (model, mindelta)
+   notes = model.pitches
+   streams = [[] for n in notes]
+   for index, transpose in band_sources:
+      folds = model.fold_table (transpose)
+      for p in range (128):
+         if index[p]:
+            for tine in folds[p]:
+               played = p + transpose
+               rank = (abs (played - notes[tine]) // 12, -played)
+               streams[tine].append ([(t, rank, played) for t in index[p]])
+
+   band = []
+   losers = []
+   report = { "collisions" : 0, "merged" : 0, "refolded" : 0,
+              "unmerged" : 0, "nudged" : 0, "dropped" : 0 }
+   for tine, stream in enumerate (streams):
+      kept = []
+      for note in heapq.merge (*stream):
+         if kept and note[0] - kept[-1][0] < mingap:
+            merged = note[0] == kept[-1][0]
+            if merged:
+               report["merged"] += 1
+            else:
+               report["collisions"] += 1
+            if note[1] < kept[-1][1]:
+               note, kept[-1] = kept[-1], note
+            losers.append ((tine, note, merged))
+         else:
+            kept.append (note)
+      band.append ([t for t, rank, played in kept])
+
+   def free (ticks, t):
+      k = bisect.bisect_left (ticks, t)
+      return ((k == 0 or t - ticks[k - 1] >= mingap) and
+              (k == len (ticks) or ticks[k] - t >= mingap))
+
+   for tine, (t, rank, played), merged in losers:
+      others = sorted ((abs (n - played), i) for i, n in enumerate (notes)
+                       if i != tine and (n - played) % 12 == 0)
+      for d, i in others:
+         if free (band[i], t):
+            bisect.insort (band[i], t)
+            report["refolded"] += 1
+            report["unmerged"] += merged
+            break
       else:
-         eventdata += bytearray([ 0x80, i, 127  ])
-      last_time += dt
-
-   eventdata += bytearray([ 0x00, 0xFF, 0x2F, 0x00 ])
-
-   outfile = open(filename, 'wb')
-   outfile.write (bytes("MThd", 'ascii') + struct.pack (">ihhh", 6, 0, 1, delta_ticks))
-   outfile.write (bytes("MTrk", 'ascii') + struct.pack (">i", len (eventdata)))
-   outfile.write (eventdata)
-   outfile.close ()
-
+         ticks = band[tine]
+         k = bisect.bisect_left (ticks, t)
+         if k < len (ticks) and ticks[k] == t:
+            continue
+         spots = [ticks[k - 1] + mingap] if k > 0 else []
+         if k < len (ticks):
+            spots.append (ticks[k] - mingap)
+         spots = [u for u in spots if u >= 0 and abs (u - t) <= mindelta and free (ticks, u)]
+         if spots:
+            bisect.insort (ticks, min (spots, key=lambda u: abs (u - t)))
+            report["nudged"] += 1
+         else:
+            report["dropped"] += 1
+   return band, report
+
+
+def band_slots (index, model, transpose, columns):
+   # The (tine, tick) slots a pitch index occupies as a bit set, ticks
+   # numbered by the columns dict, and the number of notes put there.
+   # Overlaps of slot sets are then an & and a bit_count ().
+   folds = model.fold_table (transpose)
+   ntines = len (model.notes)
+   bitmap = bytearray ((len (columns) * ntines + 7) // 8)
+   total = 0
+   for p in range (128):
+      if index[p]:
+         for tine in folds[p]:
+            for t in index[p]:
+               slot = columns[t] * ntines + tine
+               bitmap[slot >> 3] |= 1 << (slot & 7)
+            total += len (index[p])
+   return int.from_bytes (bitmap, "little"), total
+
+
+def shift_costs (weights, available_notes, shifts):
+   # The cost of every shift at once: the weight of all notes minus the
+   # weight landing on a playable note, i.e. the correlation of the
+   # histogram with the notes of the box.
+   total = sum (weights)
+   played = collections.Counter ()
+   used = [p for p in range (128) if weights[p]]
+   for q in set (available_notes):
+      for p in used:
+         played[q - p] += weights[p]
+   return [total - played[s] for s in shifts]
+
+
+# weight of the melody track for the "melody" transpose cost
+melody_weight = 4
+
+# Transpose cost functions, called with (roll, available_notes, model,
+# shifts) and returning a cost for each shift.
+
+def cost_unplayable (roll, available_notes, model, shifts):
+   return shift_costs (roll.histogram (), available_notes, shifts)
+
+
+def cost_duration (roll, available_notes, model, shifts):
+   return shift_costs (roll.histogram (durations=True),
+                       available_notes, shifts)
+
+
+def cost_melody (roll, available_notes, model, shifts):
+   weights = { roll.melody_track () : melody_weight }
+   return shift_costs (roll.histogram (track_weights=weights),
+                       available_notes, shifts)
+
+
+def cost_collisions (roll, available_notes, model, shifts):
+   if model is None:
+      raise Exception ("the collisions cost needs a box model")
+   index = roll.pitch_index ()
+   return [sum (band_losses ([(index, s)], model)) for s in shifts]
+
+
+transpose_costs = {
+   "unplayable" : cost_unplayable,
+   "duration"   : cost_duration,
+   "melody"     : cost_melody,
+   "collisions" : cost_collisions,
+}
 
 
 class Note (object):
-   def __init__ (self, note, ticks, channel, track):
+   def __init__ (self, note, ticks, channel, track, duration=0):
       self.note = note
       self.ticks = ticks
       self.channel = channel
       self.track = track
+      self.duration = duration
       self.filtered = set()
 
 
@@ -315,9 +1379,11 @@ class Note (object):
 
 
 class PianoRoll (object):
-   def __init__ (self, notes=[]):
-      self.notes = notes
+   def __init__ (self, notes=None):
+      self.notes = list (notes) if notes is not None else []
+      # a number, or a list of numbers per track/channel
       self.transpose = 0
+      self.transpose_by = "track"
 
 
    def __repr__ (self):
@@ -328,31 +1394,72 @@ class PianoRoll (object):
       self.notes.append (note)
 
 
-   def get_compat_band (self, model):
-      self.notes.sort (key=lambda x: x.ticks)
+   def retime (self, tempo_map):
+      # move the notes onto the timeline of tempo_map
+      if tempo_map.constant:
+         return
+      starts = tempo_map.timeline (n.ticks for n in self.notes)
+      ends = tempo_map.timeline (n.ticks + n.duration for n in self.notes)
+      for n, t, e in zip (self.notes, starts, ends):
+         n.ticks, n.duration = t, e - t
+
+
+   def histogram (self, durations=False, track_weights=None):
+      if not durations and not track_weights:
+         return note_histogram (self.notes)
+      return weighted_histogram (((n.note, n.duration, n.track) for n in self.notes),
+                                 durations, track_weights)
+
+
+   def melody_track (self):
+      return highest_track ((n.note, n.track) for n in self.notes)
+
+
+   def pitch_index (self):
+      # sorted unique ticks of the unfiltered notes, per midi note
+      pitch_ticks = [set () for i in range (128)]
+      for n in self.notes:
+         if not n.filtered:
+            pitch_ticks[n.note].add (n.ticks)
+      return [sorted (t) for t in pitch_ticks]
+
+
+   def voice_index (self, by="track"):
+      # pitch_index per track or channel
+      pitch_ticks = {}
+      for n in self.notes:
+         if not n.filtered:
+            v = getattr (n, by)
+            if v not in pitch_ticks:
+               pitch_ticks[v] = [set () for i in range (128)]
+            pitch_ticks[v][n.note].add (n.ticks)
+      return dict ((v, [sorted (t) for t in p]) for v, p in pitch_ticks.items ())
 
-      # all the notes in the piece
-
-      notes = [n + model["lowest"] for n in model["notes"]]
-      # available notes
-
-      band = [[] for i in range (len(notes))]
-      for i in range (len (notes)):
-         source_notes = [notes[i]]
-         n = notes[i] - 12
-         while n >= 0 and n not in notes:
-            source_notes.append (n)
-            n -= 12
-         n = notes[i] + 12
-         while n <= 127 and  n not in notes:
-            source_notes.append (n)
-            n += 12
-
-         band[i] = [n.ticks for n in self.notes
-                        if n.note + self.transpose in source_notes
-                        #if n.note + self.transpose[n.track % len (self.transpose)] in source_notes
-                        if not n.filtered]
-         band[i] = sorted (list (set (band[i])))
+
+   def band_sources (self):
+      # (pitch index, transpose) pairs making up the band
+      if isinstance (self.transpose, int):
+         return [(self.pitch_index (), self.transpose)]
+      return [(index, self.transpose[v % len (self.transpose)])
+              for v, index in sorted (self.voice_index (self.transpose_by).items ())]
+
+
+   def get_compat_band (self, model):
+      # all the source notes of a tine, each one a sorted tick list
+      band = [[] for i in range (len (model.notes))]
+      for index, transpose in self.band_sources ():
+         folds = model.fold_table (transpose)
+         for p in range (128):
+            if index[p]:
+               for tine in folds[p]:
+                  band[tine].append (index[p])
+
+      for i in range (len (band)):
+         if len (band[i]) == 1:
+            band[i] = list (band[i][0])
+         else:
+            # k-way merge of the octaves folded onto this tine
+            band[i] = [t for t, _ in itertools.groupby (heapq.merge (*band[i]))]
       return band
 
 
@@ -371,17 +1478,18 @@ class PianoRoll (object):
       return mindelta
 
 
-   def find_transpose (self, available_notes,
-                       allow_octaves=True, allow_halftones=True):
-      transpose = 0
-      transpose_error = sys.maxsize #sys.maxint
-
-      highest = max ([n.note for n in self.notes])
-      lowest  = min ([n.note for n in self.notes])
-
-      notecount = [len ([n for n in self.notes if n.note == i])
-                   for i in range (128)]
+   def rank_transpose (self, available_notes,
+                       allow_octaves=True, allow_halftones=True,
+                       cost="unplayable", model=None):
+      # all candidate transpositions as (cost, transpose), best first
+      notecount = self.histogram ()
+      used = [i for i in range (128) if notecount[i]]
+      if not used:
+         return [(0, 0)]
+      highest = used[-1]
+      lowest  = used[0]
 
+      shifts = []
       for trans in range (min (available_notes) - highest - 1,
                           max (available_notes) - lowest + 2):
 
@@ -391,19 +1499,169 @@ class PianoRoll (object):
          if not allow_halftones and not allow_octaves and trans % 12 == 0:
             continue
 
-         errcount = 0
-         for i in range (128):
-            if (i+trans) not in available_notes:
-               errcount += notecount[i]
-         if errcount < transpose_error or (errcount == transpose_error and abs(trans) < abs (transpose)):
-            transpose_error = errcount
-            transpose = trans
+         shifts.append (trans)
+
+      if not callable (cost):
+         cost = transpose_costs[cost]
+      costs = cost (self, available_notes, model, shifts)
 
+      # on ties prefer the smaller transposition, downwards first
+      return sorted (zip (costs, shifts),
+                     key=lambda x: (x[0], abs (x[1]), x[1]))
+
+
+   def find_transpose (self, available_notes,
+                       allow_octaves=True, allow_halftones=True,
+                       cost="unplayable", model=None, top=1):
+      ranking = self.rank_transpose (available_notes,
+                                     allow_octaves, allow_halftones,
+                                     cost, model)
+      if ranking:
+         transpose_error, transpose = ranking[0]
+      else:
+         transpose_error, transpose = sys.maxsize, 0
+
+      if cost != "unplayable":
+         unplayable = cost_unplayable (self, available_notes, model, [transpose])[0]
+      else:
+         unplayable = transpose_error
 
       # sys.stderr.write(  "transposing by %d octaves and %d halftones\n" % (transpose / 12, transpose % 12))
       # sys.stderr.write(  "    --> %d notes not playable\n" % (transpose_error))
       print(  "transposing by %d octaves and %d halftones" % (transpose / 12, transpose % 12))
-      print(  "    --> %d notes not playable" % (transpose_error))
+      print(  "    --> %d notes not playable" % (unplayable))
+      if cost != "unplayable":
+         print(  "    --> %s cost %g" % (getattr (cost, "__name__", cost), transpose_error))
+      if top > 1:
+         for c, t in ranking[:top]:
+            print(  "        %+4d: %g" % (t, c))
+
+      return transpose
+
+
+   def unplayable (self, model):
+      # unfiltered notes not directly playable with the current transposition
+      return sum (model.unplayable (index, transpose)
+                  for index, transpose in self.band_sources ())
+
+
+   def find_voice_transpose (self, model, by="track", base=None,
+                             octaves=2, max_nodes=100000, max_work=10**8):
+      # A transposition per track (or channel): base plus some octaves for
+      # every voice, minimizing the notes not directly playable plus the
+      # notes colliding on a tine. Branch and bound over the voices, the
+      # biggest first.
+      #
+      # The collisions of a set of voices are the sum of their slot counts
+      # minus the size of the union, whatever the order. Only ticks played
+      # by two voices or more can collide across voices, so the slot sets
+      # for that cover just those ticks; collisions inside a voice are part
+      # of its own cost. max_work limits the machine words run through &.
+      available = model.pitches
+      if base is None:
+         base = self.rank_transpose (available)[0][1]
+      shifts = [base + 12 * k for k in range (-octaves, octaves + 1)]
+
+      vindex = self.voice_index (by)
+      voice_ticks = {}
+      for v, index in vindex.items ():
+         voice_ticks[v] = set ().union (*index)
+      seen = set ()
+      shared = set ()
+      for ticks in voice_ticks.values ():
+         shared.update (ticks & seen)
+         seen.update (ticks)
+      columns = dict ((t, i) for i, t in enumerate (sorted (shared)))
+      words = len (columns) * len (model.notes) // 64 + 16
+
+      voices = []
+      for v, index in vindex.items ():
+         weights = [len (t) for t in index]
+         own_columns = dict ((t, i) for i, t in enumerate (sorted (voice_ticks[v])))
+         shared_index = [[t for t in ticks if t in shared] for ticks in index]
+         choices = []
+         for s, u in zip (shifts, shift_costs (weights, available, shifts)):
+            slots, total = band_slots (index, model, s, own_columns)
+            own = u + total - slots.bit_count ()
+            slots, total = band_slots (shared_index, model, s, columns)
+            choices.append ((own, s, slots))
+         choices.sort (key=lambda c: (c[0], abs (c[1] - base)))
+         voices.append ((-sum (weights), v, choices))
+      voices.sort (key=lambda x: x[:2])
+
+      # work in machine words, plus some for the call
+      work = [0]
+      def collisions (slots, used):
+         work[0] += words
+         return (slots & used).bit_count ()
+
+      # start from a greedy assignment, improved one voice at a time, so
+      # the search has a tight upper bound from the beginning; moving a
+      # voice costs its own cost plus its overlap with all the others
+      choice = []
+      used = 0
+      current = 0
+      for _, _, choices in voices:
+         c = min (range (len (choices)),
+                  key=lambda c: choices[c][0] + collisions (choices[c][2], used))
+         own, s, slots = choices[c]
+         current += own + collisions (slots, used)
+         used |= slots
+         choice.append (c)
+      improved = True
+      while improved and work[0] < max_work:
+         improved = False
+         for d, (_, _, choices) in enumerate (voices):
+            others = 0
+            for e, (_, _, other) in enumerate (voices):
+               if e != d:
+                  others |= other[choice[e]][2]
+            costs = [own + collisions (slots, others) for own, s, slots in choices]
+            c = min (range (len (choices)), key=costs.__getitem__)
+            if costs[c] < costs[choice[d]]:
+               current += costs[c] - costs[choice[d]]
+               choice[d] = c
+               improved = True
+
+      best = [current, [voices[d][2][c][1] for d, c in enumerate (choice)]]
+      picks = []
+      nodes = [0]
+
+      def search (d, cost, used):
+         if d == len (voices):
+            if cost < best[0]:
+               best[:] = [cost, list (picks)]
+            return
+         # every voice still to place costs at least its own cost plus
+         # the collisions with the voices placed so far
+         options = [(own + collisions (slots, used), s, slots)
+                    for own, s, slots in voices[d][2]]
+         options.sort (key=lambda o: (o[0], abs (o[1] - base)))
+         rest = 0
+         for _, _, choices in voices[d+1:]:
+            if cost + options[0][0] + rest >= best[0]:
+               break
+            rest += min (own + collisions (slots, used) for own, s, slots in choices)
+         for c, s, slots in options:
+            if (cost + c + rest >= best[0] or
+                nodes[0] >= max_nodes or work[0] >= max_work):
+               break
+            nodes[0] += 1
+            picks.append (s)
+            search (d + 1, cost + c, used | slots)
+            picks.pop ()
+
+      search (0, 0, 0)
+
+      nvoices = max ([v for _, v, _ in voices] or [0]) + 1
+      transpose = [base] * nvoices
+      for (_, v, _), s in zip (voices, best[1] or []):
+         transpose[v] = s
+
+      truncated = nodes[0] >= max_nodes or work[0] >= max_work
+      for v in sorted (v for _, v, _ in voices):
+         print(  "transposing %s %d by %d octaves and %d halftones" % (by, v, transpose[v] // 12, transpose[v] % 12))
+      print(  "    --> %d notes not playable or colliding%s" % (best[0], " (search truncated)" if truncated else ""))
 
       return transpose
 
@@ -430,15 +1688,347 @@ class PianoRoll (object):
 
 
 
+# bits in CompactPianoRoll.filtered, one per reason name in Note.filtered
+filter_bits = {
+   "delta" : 0x01,
+}
+
+
+class NoteView (object):
+   # read-only Note lookalike for one row of a CompactPianoRoll
+   __slots__ = ("roll", "index")
+
+   def __init__ (self, roll, index):
+      self.roll = roll
+      self.index = index
+
+   note    = property (lambda self: self.roll.note[self.index])
+   ticks   = property (lambda self: self.roll.ticks[self.index])
+   channel = property (lambda self: self.roll.channel[self.index])
+   track   = property (lambda self: self.roll.track[self.index])
+   duration = property (lambda self: self.roll.duration[self.index])
+
+   @property
+   def filtered (self):
+      mask = self.roll.filtered[self.index]
+      return frozenset (k for k, bit in filter_bits.items () if mask & bit)
+
+
+   def __repr__ (self):
+      return "Note (%s, %d, %d, %d)" % (self.note, self.ticks, self.channel, self.track)
+
+
+class CompactPianoRoll (PianoRoll):
+   # Stores the notes in parallel typed arrays (~13 bytes per note)
+   # instead of Note objects. The notes attribute is a view for
+   # compatibility with code written against PianoRoll.
+
+   def __init__ (self, notes=None):
+      self.note     = array.array ('B')
+      self.ticks    = array.array ('q')
+      self.channel  = array.array ('B')
+      self.track    = array.array ('H')
+      self.duration = array.array ('q')
+      self.filtered = array.array ('B')
+      self.transpose = 0
+      self.transpose_by = "track"
+      self.order = None
+      self.counts = None
+      self.indexes = {}
+      # hash of the midi file the notes came from, for the cache
+      self.digest = None
+      for n in notes or []:
+         self.add (n)
+
+
+   def __len__ (self):
+      return len (self.note)
+
+
+   @property
+   def notes (self):
+      return [NoteView (self, i) for i in range (len (self.note))]
+
+
+   def add (self, note):
+      self.append (note.note, note.ticks, note.channel, note.track,
+                   note.duration)
+
+
+   def retime (self, tempo_map):
+      if tempo_map.constant:
+         return
+      ends = tempo_map.timeline (map (operator.add, self.ticks, self.duration))
+      self.ticks = tempo_map.timeline (self.ticks)
+      self.duration = array.array ('q', map (operator.sub, ends, self.ticks))
+      self.order = None
+      self.indexes = {}
+
+
+   def append (self, note, ticks, channel, track, duration=0, filtered=0):
+      self.note.append (note)
+      self.ticks.append (ticks)
+      self.channel.append (channel)
+      self.track.append (track)
+      self.duration.append (duration)
+      self.filtered.append (filtered)
+      self.order = None
+      self.counts = None
+      self.indexes = {}
+
+
+   def pitch_order (self):
+      # row indices sorted by note, then ticks, then insertion order.
+      # This is the order filter_repetition and min_repetition walk.
+      if self.order is None:
+         self.order = array.array ('l', [i for n, t, i in
+                                         sorted (zip (self.note, self.ticks,
+                                                      range (len (self.note))))])
+      return self.order
+
+
+   def histogram (self, durations=False, track_weights=None):
+      if durations or track_weights:
+         return weighted_histogram (zip (self.note, self.duration, self.track),
+                                    durations, track_weights)
+      if self.counts is None:
+         self.counts = [0] * 128
+         for n, c in collections.Counter (self.note).items ():
+            self.counts[n] = c
+      return list (self.counts)
+
+
+   def melody_track (self):
+      return highest_track (zip (self.note, self.track))
+
+
+   def pitch_index (self):
+      if None not in self.indexes:
+         pitch_ticks = [set () for i in range (128)]
+         for n, t, f in zip (self.note, self.ticks, self.filtered):
+            if not f:
+               pitch_ticks[n].add (t)
+         self.indexes[None] = [array.array ('q', sorted (t)) for t in pitch_ticks]
+      return self.indexes[None]
+
+
+   def voice_index (self, by="track"):
+      if by not in self.indexes:
+         pitch_ticks = {}
+         for v, n, t, f in zip (getattr (self, by), self.note, self.ticks, self.filtered):
+            if not f:
+               if v not in pitch_ticks:
+                  pitch_ticks[v] = [set () for i in range (128)]
+               pitch_ticks[v][n].add (t)
+         self.indexes[by] = dict ((v, [array.array ('q', sorted (t)) for t in p])
+                                  for v, p in pitch_ticks.items ())
+      return self.indexes[by]
+
+
+   def min_repetition (self):
+      if not self.note:
+         return sys.maxsize
+
+      order = self.pitch_order ()
+      # Encode (note, ticks) in one integer so that differences between
+      # neighbours of the same note stay <= maxtick and differences across
+      # notes exceed it. The set of differences is then computed at C speed.
+      maxtick = max (self.ticks) - min (0, min (self.ticks))
+      scale = 2 * (maxtick + 1)
+      keys = [self.note[i] * scale + self.ticks[i] for i in order]
+      deltas = set (map (operator.sub, keys[1:], keys[:-1]))
+      # notes at the same tick are considered identical
+      return min ((d for d in deltas if 0 < d <= maxtick), default=sys.maxsize)
+
+
+   def filter_repetition (self, delta):
+      order = self.pitch_order ()
+      note = self.note
+      ticks = self.ticks
+      filtered = self.filtered
+      bit = filter_bits["delta"]
+
+      count = 0
+      last_note = -1
+      last_ticks = 0
+      for i in order:
+         n = note[i]
+         t = ticks[i]
+         if n == last_note and t - last_ticks < delta:
+            filtered[i] |= bit
+            count += 1
+         else:
+            filtered[i] &= ~bit
+            last_note = n
+            last_ticks = t
+
+      self.indexes = {}
+      return count
+
+
+
+class RollSession (object):
+   # For trying filter and transpose settings on a CompactPianoRoll. The
+   # notes are kept in pitch order with the gap to the previous onset of
+   # the same pitch. A new filter delta only walks the notes closer than
+   # delta to their predecessor (sorted back into pitch order, the only
+   # sort per call) and updates the pitch index for the pitches that
+   # changed, a new transposition only folds that index again.
+
+   def __init__ (self, roll):
+      self.roll = roll
+      self.order = roll.pitch_order ()
+      note = [roll.note[i] for i in self.order]
+      self.ticks = array.array ('q', [roll.ticks[i] for i in self.order])
+      # positions of every pitch: starts[p] to starts[p + 1]
+      self.starts = [bisect.bisect_left (note, p) for p in range (129)]
+
+      gaps = [sys.maxsize] + list (map (operator.sub, self.ticks[1:], self.ticks[:-1]))
+      for k in self.starts[:128]:
+         if k < len (gaps):
+            gaps[k] = sys.maxsize
+      self.by_gap = sorted (range (len (gaps)), key=gaps.__getitem__)
+      self.gaps = [gaps[k] for k in self.by_gap]
+      # notes at the same tick are considered identical
+      self.mindelta = self.gaps[bisect.bisect_right (self.gaps, 0)]
+
+      bit = filter_bits["delta"]
+      self.filtered = set (k for k in range (len (self.order))
+                           if roll.filtered[self.order[k]] & bit)
+
+
+   def filter (self, delta):
+      # like roll.filter_repetition (delta), returns the number of
+      # filtered notes. The first note of a pitch and every note at least
+      # delta after its predecessor is kept anyway.
+      ticks = self.ticks
+      filtered = set ()
+      prev = -2
+      for k in sorted (self.by_gap[:bisect.bisect_left (self.gaps, delta)]):
+         if k != prev + 1:
+            last = ticks[k - 1]
+         if ticks[k] - last < delta:
+            filtered.add (k)
+         else:
+            last = ticks[k]
+         prev = k
+
+      roll = self.roll
+      bit = filter_bits["delta"]
+      index = roll.indexes.get (None)
+      changed = set ()
+      for k in self.filtered - filtered:
+         roll.filtered[self.order[k]] &= ~bit
+         changed.add (roll.note[self.order[k]])
+      for k in filtered - self.filtered:
+         roll.filtered[self.order[k]] |= bit
+         changed.add (roll.note[self.order[k]])
+      self.filtered = filtered
+
+      # the voice indexes are rebuilt when needed, the pitch index is
+      # patched for the pitches that changed
+      roll.indexes = {}
+      if index is not None:
+         for p in changed:
+            index[p] = array.array ('q', [t for t, _ in itertools.groupby (
+                                       ticks[k] for k in range (self.starts[p], self.starts[p + 1])
+                                       if k not in filtered)])
+         roll.indexes[None] = index
+      return len (filtered)
+
+
+   def band (self, model, transpose=None):
+      if transpose is not None:
+         self.roll.transpose = transpose
+      return self.roll.get_compat_band (model)
+
+
+   def min_repetition (self):
+      return self.mindelta
+
+
+
+class TempoMap (object):
+   # The tempo changes of a midi file. Holes and the simulation midi are
+   # placed on a timeline of ticks at the fastest tempo of the piece, so
+   # distances along the band follow the time and no two ticks of the
+   # file fall together. For every change the tick and the time up to it
+   # (in microseconds * timediv, exact integers) are precomputed, a tick
+   # is mapped by bisecting the changes. With one tempo (or SMPTE time
+   # division, where ticks are time already) the ticks stay as they are.
+
+   def __init__ (self, timediv, tempos):
+      self.timediv = timediv
+      self.ticks = [0]
+      self.times = [0]
+      self.tempi = [default_tempo]
+      # sorted is stable: of several changes at a tick the last one counts
+      for ticks, tempo in sorted (tempos, key=operator.itemgetter (0)):
+         if tempo <= 0:
+            continue
+         if ticks == self.ticks[-1]:
+            self.tempi[-1] = tempo
+         elif tempo != self.tempi[-1]:
+            self.times.append (self.times[-1] + (ticks - self.ticks[-1]) * self.tempi[-1])
+            self.ticks.append (ticks)
+            self.tempi.append (tempo)
+      self.tempo = min (self.tempi)
+      self.constant = timediv <= 0 or len (set (self.tempi)) == 1
+
+
+   def time (self, ticks):
+      # microseconds * timediv from the start to ticks
+      i = bisect.bisect_right (self.ticks, ticks) - 1
+      return self.times[i] + (ticks - self.ticks[i]) * self.tempi[i]
+
+
+   def seconds (self, ticks):
+      if self.timediv <= 0:
+         # SMPTE: frames per second (negative) and ticks per frame
+         return ticks / (-(self.timediv >> 8) * (self.timediv & 0xff))
+      return self.time (ticks) / (1e6 * self.timediv)
+
+
+   def timeline (self, ticks):
+      # ticks (any iterable) at self.tempo, rounded, as an array
+      if self.constant:
+         return array.array ('q', ticks)
+      changes, times, tempi = self.ticks, self.times, self.tempi
+      search = bisect.bisect_right
+      tempo = self.tempo
+      result = array.array ('q')
+      for t in ticks:
+         i = search (changes, t) - 1
+         result.append ((2 * (times[i] + (t - changes[i]) * tempi[i]) + tempo) //
+                        (2 * tempo))
+      return result
+
+
 class MidiImporter (object):
-   def __init__ (self, target):
+   def __init__ (self, target=None, track_cache=None):
       self.target = target
+      # notes of tracks parsed before, see cached_track_notes
+      self.track_cache = track_cache
+      self.used_tracks = set ()
       self.timediv = 0
       self.num_tracks = 0
       self.cur_program = -1
-
-
-   def import_event (self, ticks, track, eventdata):
+      # concatenated MIDI files continue after the end of the previous one
+      self.tick_offset = 0
+      self.end_ticks = 0
+      # events parsed, cached tracks are not parsed again
+      self.events = 0
+      # (ticks, microseconds per quarter note) of the tempo changes
+      self.tempos = []
+      # microseconds per quarter note of the timeline, see load_roll
+      self.tempo = default_tempo
+      # sounding notes of the current track, by (channel, note)
+      self.open_notes = {}
+      # notes fed to import_event that wait for their note-off
+      self.pending_notes = collections.deque ()
+
+
+   def decode_event (self, ticks, track, eventdata):
       cur_program = -1;
       mc = eventdata[0] >> 4
 
@@ -449,13 +2039,18 @@ class MidiImporter (object):
          mc = 0x08
 
       if mc == 0x08:
-         pass
          # print >>sys.stderr, ticks, ": noteoff"
+         sounding = self.open_notes.get ((ch, eventdata[1]))
+         if sounding:
+            n = sounding.pop (0)
+            n.duration = ticks - n.ticks
       elif mc == 0x09:
          # print >>sys.stderr, ticks, ": noteon (%d)" % (ord(eventdata[0]) & 0x0f), ord (eventdata[1]), ord (eventdata[2])
          if self.cur_program != 127: # exclude percussion track
-            n = Note (eventdata[1], ticks, ch, track)
-            self.target.add (n)
+            # duration -1 until the note-off
+            n = Note (eventdata[1], ticks, ch, track, -1)
+            self.open_notes.setdefault ((ch, eventdata[1]), []).append (n)
+            return n
       elif mc == 0x0b:
          # print >>sys.stderr, ticks, ": controller", ord (eventdata[1])
          pass
@@ -470,150 +2065,1129 @@ class MidiImporter (object):
       elif mc == 0x0e:
          # print >>sys.stderr, ticks, ": pitch bend"
          pass
+      elif eventdata[0] == 0xff and eventdata[1] == 0x51 and len (eventdata) == 5:
+         # set tempo, microseconds per quarter note
+         self.tempos.append ((ticks, int.from_bytes (eventdata[2:5], "big")))
       else:
          #print("ticks: %d, event %r" % (ticks, eventdata))
          # sys.stderr.write("ticks: %d, event %r" % (ticks, eventdata))
          pass
 
+      return None
 
-   def import_ticked_events (self, track, eventdata):
-      ticks = 0
+
+   def import_event (self, ticks, track, eventdata):
+      # One event at a time. As in track_notes a note is added once it
+      # has ended and the notes started before it were added; the end of
+      # track meta event adds the notes that never end with duration 0.
+      n = self.decode_event (ticks, track, eventdata)
+      pending = self.pending_notes
+      if n:
+         pending.append (n)
+      end = eventdata[:2] == b"\xff\x2f"
+      while pending and (pending[0].duration >= 0 or end or
+                         len (pending) > self.max_pending):
+         n = pending.popleft ()
+         n.duration = max (n.duration, 0)
+         self.target.add (n)
+      if end:
+         self.open_notes = {}
+
+
+   def iter_events (self, eventdata):
+      # walk the track by offset, slicing only the bytes of each event
+      data = memoryview (eventdata)
+      end = len (data)
+      pos = 0
+      ticks = self.tick_offset
       mc = None
-      t = eventdata
-      while t:
-         dt = 0
-         while t[0] & 0x80:
-            dt = (dt + (t[0] & 0x7f)) << 7
-
-            t = t[1:]
-         dt += t[0]
-
-         t = t[1:]
-
-         if t[0] & 0x80:
-            mc = t[0]
-            t = t[1:]
-
-         if mc >> 4 in [0x08, 0x09, 0x0a, 0x0b, 0x0e]:
-            command = bytes([mc]) + t[:2]
-            t = t[2:]
-
-         elif mc >> 4 in [0x0c, 0x0d]:
-            command = bytes([mc]) + t[:1]
-            t = t[1:]
-         elif mc in [0xf8, 0xfa, 0xfb, 0xfc]:
-            command = mc
-         elif mc == 0xff:
-            type = t[0]
-            t = t[1:]
-
-            command = [mc] + [type]
-
-
-            l = 0
-            while t[0] & 0x80:
-               command += t[0]
-               l = (l + (t[0] & 0x7f)) << 7
-               t = t[1:]
-            l += t[0]
-
-            command += t[:l+1]
-
-            t = t[l+1:]
-         elif mc in [0xf0, 0xf7]:
-            command = mc
-            l = 0
-            while t[0] & 0x80:
-               command += t[0]
-               l = (l + (t[0] & 0x7f)) << 7
-               t = t[1:]
-            l += t[0]
-            command = bytes([command]) + t[:l+1]
-            t = t[l+1:]
+      count = 0
+      while pos < end:
+         dt, pos = read_vlq (data, pos)
+
+         if data[pos] & 0x80:
+            status = data[pos]
+            pos += 1
+         elif mc is None:
+            raise Exception("MIDI data byte without running status at offset %d" % pos)
          else:
-            raise Exception('unknown MIDI event: %d' % ord (t[0]))
+            status = mc
+
+         if status >> 4 in [0x08, 0x09, 0x0a, 0x0b, 0x0e]:
+            mc = status
+            command = bytes ([status]) + data[pos:pos+2]
+            pos += 2
+         elif status >> 4 in [0x0c, 0x0d]:
+            mc = status
+            command = bytes ([status]) + data[pos:pos+1]
+            pos += 1
+         elif status in [0xf8, 0xfa, 0xfb, 0xfc]:
+            command = bytes ([status])
+         elif status == 0xff:
+            # meta event: type, length, data. Cancels running status.
+            mc = None
+            metatype = data[pos]
+            l, pos = read_vlq (data, pos + 1)
+            command = bytes ([status, metatype]) + data[pos:pos+l]
+            pos += l
+         elif status in [0xf0, 0xf7]:
+            # sysex event: length, data. Cancels running status.
+            mc = None
+            l, pos = read_vlq (data, pos)
+            command = bytes ([status]) + data[pos:pos+l]
+            pos += l
+         else:
+            raise Exception('unknown MIDI event: %d' % status)
+
+         if pos > end:
+            raise Exception("MIDI event exceeds end of track")
 
          ticks += dt
-         self.import_event (ticks, track, command)
+         count += 1
+         yield ticks, command
+
+      self.events += count
+      self.end_ticks = max (self.end_ticks, ticks)
+
+
+   # notes held back behind a note that does not end
+   max_pending = 10000
+
+   def track_notes (self, track, eventdata):
+      # The notes of a track in the order they start. A note is passed on
+      # once it has ended and the notes started before it were passed on,
+      # so only the sounding notes (and the ones started meanwhile) are
+      # held. Notes that never end get duration 0.
+      pending = collections.deque ()
+      self.open_notes = {}
+      for ticks, command in self.iter_events (eventdata):
+         n = self.decode_event (ticks, track, command)
+         if n:
+            pending.append (n)
+         while pending and (pending[0].duration >= 0 or
+                            len (pending) > self.max_pending):
+            n = pending.popleft ()
+            n.duration = max (n.duration, 0)
+            yield n
+      for n in pending:
+         n.duration = max (n.duration, 0)
+         yield n
+      self.open_notes = {}
+
+
+   def cached_track_notes (self, track, eventdata):
+      # track_notes, reusing the notes of a track that was parsed before
+      # with the same data and starting state. The watch mode keeps the
+      # cache, so that after an edit only the changed tracks are parsed.
+      import hashlib
+      key = (hashlib.sha1 (eventdata).digest (), track,
+             self.tick_offset, self.cur_program)
+      self.used_tracks.add (key)
+      if key not in self.track_cache:
+         end_ticks = self.end_ticks
+         self.end_ticks = self.tick_offset
+         first_tempo = len (self.tempos)
+         notes = list (self.track_notes (track, eventdata))
+         self.track_cache[key] = (notes, self.cur_program, self.end_ticks,
+                                  self.tempos[first_tempo:])
+         del self.tempos[first_tempo:]
+         self.end_ticks = max (self.end_ticks, end_ticks)
+
+      notes, self.cur_program, end_ticks, tempos = self.track_cache[key]
+      self.end_ticks = max (self.end_ticks, end_ticks)
+      self.tempos += tempos
+      return notes
+
+
+   def forget_unused_tracks (self):
+      # drop the cached tracks that were not part of the last import
+      for key in set (self.track_cache) - self.used_tracks:
+         del self.track_cache[key]
 
 
-   def import_chunk (self, chunkname, chunkdata):
+   def import_ticked_events (self, track, eventdata):
+      for n in self.track_notes (track, eventdata):
+         self.target.add (n)
+
+
+   def iter_chunk_notes (self, chunkname, chunkdata):
       if self.timediv == 0 and chunkname != b'MThd':
          raise Exception("first chunk is not MThd\n")
 
       if chunkname == b'MThd':
 
-         global delta_ticks
+         if len (chunkdata) != 6:
+            raise Exception("invalid MThd chunk\n")
+         mtype, n_tracks, timediv = struct.unpack (">hhh", chunkdata)
 
          if self.timediv != 0:
-            raise Exception("multiple MThd chunks\n")
+            # another MIDI file concatenated to the stream
+            if timediv != self.timediv:
+               raise Exception("concatenated MIDI files differ in time division\n")
+            self.tick_offset = self.end_ticks
 
-         if len (chunkdata) != 6:
-            raise Exception("invalid MThd chunk\n")
-         mtype, n_tracks, delta_ticks = struct.unpack (">hhh", chunkdata)
-         self.timediv = delta_ticks
+         self.timediv = timediv
 
-         #sys.stderr.write("type: %d, n_tracks: %d, delta_ticks: %d\n" % (mtype, n_tracks, delta_ticks))
+         #sys.stderr.write("type: %d, n_tracks: %d, timediv: %d\n" % (mtype, n_tracks, timediv))
 
       elif chunkname == b'MTrk':
-         self.import_ticked_events (self.num_tracks, chunkdata)
+         track = self.num_tracks
          self.num_tracks += 1
+         if self.track_cache is None:
+            yield from self.track_notes (track, chunkdata)
+         else:
+            yield from self.cached_track_notes (track, chunkdata)
+
+
+   def import_chunk (self, chunkname, chunkdata):
+      for n in self.iter_chunk_notes (chunkname, chunkdata):
+         self.target.add (n)
+
+
+   def iter_chunks (self, fileobj):
+      # read chunk by chunk, so pipes and huge files are never held in full
+      while True:
+         header = fileobj.read (8)
+         if not header:
+            break
+         if len (header) < 8:
+            sys.stderr.write( "%d bytes remaining at end of MIDI file\n" % len(header))
+            break
+         chunkname = header[:4]
+         chunklen = struct.unpack (">I", header[4:8])[0]
+         chunkdata = fileobj.read (chunklen)
+         if len (chunkdata) < chunklen:
+            raise Exception("Not enough bytes in MIDI file")
+         sys.stderr.write( chunkname.decode('utf-8'))
+         sys.stderr.write(str(chunklen))
+         yield chunkname, chunkdata
+
+
+   def iter_notes (self, fileobj):
+      for chunkname, chunkdata in self.iter_chunks (fileobj):
+         yield from self.iter_chunk_notes (chunkname, chunkdata)
 
 
    def import_file (self, filename):
+      if filename == "-":
+         for n in self.iter_notes (sys.stdin.buffer):
+            self.target.add (n)
+         return
 
       with open(filename, 'rb') as f:
-         t = f.read()
+         for n in self.iter_notes (f):
+            self.target.add (n)
 
-         while t:
-            if len (t) < 8:
-               sys.stderr.write( "%d bytes remaining at end of MIDI file\n" % len(t))
-               break
-            chunkname = t[:4]
-            chunklen = struct.unpack (">I", t[4:8])[0]
-            if len (t) < 8+chunklen:
-               raise Exception("Not enough bytes in MIDI file")
-            chunkdata = t[8:8+chunklen]
-            sys.stderr.write( chunkname.decode('utf-8'))
-            sys.stderr.write(str(chunklen))
-            self.import_chunk(chunkname, chunkdata)
-            t = t[8+chunklen:]
-      f.closed
+
+   def tempo_map (self):
+      return TempoMap (self.timediv, self.tempos)
+
+
+class RollCache (object):
+   # On-disk cache for parsed rolls and the results derived from them,
+   # keyed by the hash of the midi file and the parameters. One pickle per
+   # entry, when the directory grows over maxsize bytes the least recently
+   # used entries are removed. An entry that cannot be read or has not
+   # the expected shape is a miss and gets computed again.
+
+   # part of every key, raise it when what is stored changes, the old
+   # entries are then never found and age out
+   version = 2
+
+   def __init__ (self, directory, maxsize=256 << 20):
+      self.directory = directory
+      self.maxsize = maxsize
+      os.makedirs (directory, exist_ok=True)
+
+
+   def file_digest (self, fileobj):
+      import hashlib
+      h = hashlib.sha256 ()
+      for block in iter (lambda: fileobj.read (1 << 20), b""):
+         h.update (block)
+      return h.hexdigest ()
+
+
+   def path (self, digest, key):
+      import hashlib
+      name = hashlib.sha256 (repr ((self.version, key)).encode ()).hexdigest ()[:16]
+      return os.path.join (self.directory, "%s-%s.pickle" % (digest[:32], name))
+
+
+   def load (self, digest, key, valid=None):
+      # the value, or None if it is not cached. valid (value) checks the
+      # shape, it may as well raise on a wrong one.
+      import pickle
+      path = self.path (digest, key)
+      try:
+         with open (path, "rb") as f:
+            value = pickle.load (f)
+         if valid and not valid (value):
+            return None
+         os.utime (path)
+      except Exception:
+         # a truncated or foreign pickle fails in any way
+         return None
+      return value
+
+
+   def store (self, digest, key, value):
+      import pickle
+      path = self.path (digest, key)
+      # several batch workers may write, so replace atomically
+      tmp = "%s.%d" % (path, os.getpid ())
+      with open (tmp, "wb") as f:
+         pickle.dump (value, f, pickle.HIGHEST_PROTOCOL)
+      os.replace (tmp, path)
+      self.evict ()
+
+
+   def evict (self):
+      entries = []
+      for name in os.listdir (self.directory):
+         if name.endswith (".pickle"):
+            path = os.path.join (self.directory, name)
+            try:
+               st = os.stat (path)
+            except OSError:
+               continue
+            entries.append ((st.st_mtime, st.st_size, path))
+
+      total = sum (e[1] for e in entries)
+      for mtime, size, path in sorted (entries):
+         if total <= self.maxsize:
+            break
+         with contextlib.suppress (OSError):
+            os.remove (path)
+         total -= size
+
+
+class StageStats (object):
+   # Wall time, CPU time and peak memory of the stages of a conversion,
+   # and counts of what they produced. Memory is the peak resident size
+   # of the process after the stage, so it only grows from stage to
+   # stage. Nothing is traced, the times are those of a normal run; with
+   # --trace-memory tracemalloc runs anyway and its peak per stage is
+   # added. Disabled, stage () costs nothing and nothing is recorded.
+
+   def __init__ (self, enabled=True):
+      self.enabled = enabled
+      self.stages = {}
+      self.counts = {}
+
+
+   def stage (self, name):
+      if not self.enabled:
+         return contextlib.nullcontext ()
+      return self.measure (name)
+
+
+   @staticmethod
+   def peak_rss ():
+      # bytes, None where there is no getrusage
+      try:
+         import resource
+      except ImportError:
+         return None
+      rss = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+      # kilobytes on Linux, bytes on macOS
+      return rss if sys.platform == "darwin" else rss * 1024
+
+
+   @contextlib.contextmanager
+   def measure (self, name):
+      tracemalloc = sys.modules.get ("tracemalloc")
+      tracing = tracemalloc is not None and tracemalloc.is_tracing ()
+      if tracing:
+         tracemalloc.reset_peak ()
+      wall = time.perf_counter ()
+      cpu = time.process_time ()
+      try:
+         yield
+      finally:
+         stage = { "wall" : time.perf_counter () - wall,
+                   "cpu"  : time.process_time () - cpu,
+                   "peak" : self.peak_rss () }
+         if tracing:
+            stage["traced"] = tracemalloc.get_traced_memory ()[1]
+         self.stages[name] = stage
+
+
+   def count (self, **counts):
+      if self.enabled:
+         self.counts.update (counts)
+
+
+   def result (self):
+      return { "stages" : self.stages, "counts" : self.counts }
+
+
+no_stats = StageStats (False)
+
+
+def print_stats (summary):
+   stats = summary["stats"]
+   sys.stderr.write ("%s:\n" % summary["file"])
+   sys.stderr.write ("  %-10s %9s %9s %11s\n" % ("stage", "wall", "cpu", "peak rss"))
+   for name, s in stats["stages"].items ():
+      line = "  %-10s %8.3fs %8.3fs" % (name, s["wall"], s["cpu"])
+      if s["peak"] is not None:
+         line += " %9.1fMB" % (s["peak"] / 1e6)
+      if "traced" in s:
+         line += " (traced %.1fMB)" % (s["traced"] / 1e6)
+      sys.stderr.write (line + "\n")
+   sys.stderr.write ("  %s\n" % ", ".join ("%s %d" % c for c in stats["counts"].items ()))
+
+
+def cached (cache, digest, key, compute, valid=None):
+   # compute () unless the result for key is in the cache, see
+   # RollCache.load for valid
+   if not cache or not digest:
+      return compute ()
+   value = cache.load (digest, key, valid)
+   if value is None:
+      value = compute ()
+      cache.store (digest, key, value)
+   return value
 
 
 def usage ():
-   sys.stderr.write( "Usage: %s [arguments] <midi-file>" % sys.argv[0])
+   sys.stderr.write( "Usage: %s [arguments] <midi-file>...\n" % sys.argv[0])
    sys.stderr.write( "  -h, --help: show usage\n")
    sys.stderr.write( "  -t, --transpose=number: transpose by n halftones (avoid auto)\n")
+   sys.stderr.write( "                 a comma separated list transposes each voice\n")
    sys.stderr.write( "  -f, --filter=number: ignore note-repetition faster than <ticks>\n")
-   sys.stderr.write( "  -b, --box=type: music box type: sankyo15, sankyo20, teanola30, sankyo33\n")
+   sys.stderr.write( "  -b, --box=type: music box type: %s\n" % ", ".join (sorted (models)))
+   sys.stderr.write( "      --models=filename: more box types from a JSON or TOML file, see README.md\n")
    sys.stderr.write( "  -m, --midi=filename: output midi file name (omit if not wanted)\n")
+   sys.stderr.write( "      --wav=filename: the music box sound as a wav file (needs numpy)\n")
    sys.stderr.write( "  -p, --pdf=filename: output pdf file name (omit if not wanted)\n")
    sys.stderr.write( "  -s, --svg=filename: output svg file name (omit if not wanted)\n")
+   sys.stderr.write( "  -g, --gcode=filename: output G-code file name for the laser cutter\n")
+   sys.stderr.write( "      --dxf=filename: output dxf file name for the laser cutter\n")
+   sys.stderr.write( "      --preview=filename: PNG preview of the strips, without pycairo\n")
+   sys.stderr.write( "                 for several files without %s: a contact sheet of their first pages\n")
+   sys.stderr.write( "      --guides: draw the tine lines in the preview\n")
+   sys.stderr.write( "  -r, --render=cairo|direct: pdf/svg writer, direct renders pages in parallel\n")
+   sys.stderr.write( "      --split=name: strip splitting: %s\n" % ", ".join (sorted (split_methods)))
+   sys.stderr.write( "  -c, --cost=name: transpose cost: %s\n" % ", ".join (sorted (transpose_costs)))
+   sys.stderr.write( "  -k, --top=number: list the best n transpositions\n")
+   sys.stderr.write( "  -v, --voices=track|channel: transpose each track/channel on its own\n")
+   sys.stderr.write( "      --watch: convert again whenever the midi file changes\n")
+   sys.stderr.write( "      --filters=list: compare a comma separated list of filter values\n")
+   sys.stderr.write( "      --all-boxes: compare how the piece fits on every box type\n")
+   sys.stderr.write( "      --analyze: only report transposition, unplayable and colliding notes\n")
+   sys.stderr.write( "      --repair: move or drop notes too close to each other on a tine\n")
+   sys.stderr.write( "      --batch=directory: convert all midi files in a directory\n")
+   sys.stderr.write( "  -j, --jobs=number: worker processes for several files or pages (default: all cores)\n")
+   sys.stderr.write( "      --cache=directory: keep parsed files and results for the next runs\n")
+   sys.stderr.write( "      --cache-size=megabytes: limit of the cache (default: 256)\n")
+   sys.stderr.write( "      --summary=filename: write a JSON summary of the results (- for stdout)\n")
+   sys.stderr.write( "      --stats: time, CPU time, peak memory and counts of every stage\n")
+   sys.stderr.write( "               (in the --summary JSON too)\n")
+   sys.stderr.write( "      --profile=filename: write a cProfile dump of the run (pstats format)\n")
+   sys.stderr.write( "      --trace-memory=filename: write a tracemalloc snapshot at the end of the run\n")
+   sys.stderr.write( "      --listen=[host:]port: address for serve (default: 127.0.0.1:8000)\n")
+   sys.stderr.write( "      --queue=number: requests waiting for a worker in serve (default: 16)\n")
+   sys.stderr.write( "  Instead of midi files, serve runs an HTTP server converting uploaded files\n")
+   sys.stderr.write( "  with the arguments as defaults, see README.md.\n")
+   sys.stderr.write( "  <midi-file> may be - to read from stdin. With several midi files\n")
+   sys.stderr.write( "  %s in the output file names is replaced by the input file name.\n")
+
+
+
+def output_name (template, filename):
+   # %s in an output file name is replaced by the input name without
+   # directory and extension
+   name = os.path.splitext (os.path.basename (filename))[0]
+   return template.replace ("%s", name)
+
+
+def load_roll (filename, options, stats=no_stats):
+   # import and filter a midi file, returns the roll, the importer and
+   # the number of filtered notes. The ticks of the roll are on the
+   # timeline of the tempo map, at the tempo mi.tempo. With a cache the
+   # notes and the filter result of a file seen before are not computed
+   # again.
+   roll = CompactPianoRoll()
+   mi = MidiImporter (roll, options["tracks"])
+   cache = options["cache"]
+   parsed = True
+
+   def retime ():
+      tempo_map = mi.tempo_map ()
+      roll.retime (tempo_map)
+      mi.tempo = tempo_map.tempo
+
+   with stats.stage ("parse"):
+      if not cache:
+         mi.import_file (filename)
+         retime ()
+      else:
+         if filename == "-":
+            source = io.BytesIO (sys.stdin.buffer.read ())
+         else:
+            source = open (filename, "rb")
+         with source:
+            roll.digest = cache.file_digest (source)
+            columns = cache.load (roll.digest, "timeline", lambda columns:
+                                  len (columns) == 7 and
+                                  all (isinstance (c, array.array) for c in columns[2:]) and
+                                  len (set (map (len, columns[2:]))) == 1)
+            if columns is None:
+               source.seek (0)
+               for n in mi.iter_notes (source):
+                  roll.add (n)
+               retime ()
+               columns = (mi.timediv, mi.tempo, roll.note, roll.ticks,
+                          roll.channel, roll.track, roll.duration)
+               cache.store (roll.digest, "timeline", columns)
+            else:
+               (mi.timediv, mi.tempo, roll.note, roll.ticks,
+                roll.channel, roll.track, roll.duration) = columns
+               roll.filtered = array.array ('B', bytes (len (roll.note)))
+               parsed = False
+
+   # a roll from the cache used no tracks, keep them for the next change
+   if options["tracks"] is not None and parsed:
+      mi.forget_unused_tracks ()
+   if not len (roll):
+      raise Exception("no notes in MIDI file")
+
+   def apply_filter ():
+      count = roll.filter_repetition (options["filter"])
+      return roll.filtered, count
+
+   with stats.stage ("filter"):
+      roll.filtered, filtered = cached (cache, roll.digest,
+                                        ("filter", options["filter"]), apply_filter,
+                                        lambda value: len (value) == 2 and
+                                                      len (value[0]) == len (roll))
+   roll.indexes = {}
+   return roll, mi, filtered
+
+
+def set_transpose (roll, model, options):
+   transpose = options["transpose"]
+   voices = options["voices"]
+   roll.transpose_by = voices or "track"
+   if transpose == None:
+      key = ("transpose", model.key, options["filter"], options["cost"], voices)
+      if options["cache"] and roll.digest:
+         roll.transpose = options["cache"].load (roll.digest, key, lambda transpose:
+                                                 isinstance (transpose, (int, list)))
+         if roll.transpose is not None:
+            print ("transposing by %s (cached)" % (roll.transpose,))
+            return
+
+      roll.transpose = roll.find_transpose (model.pitches,
+                                            cost=options["cost"], model=model,
+                                            top=options["top"])
+      if voices:
+         roll.transpose = roll.find_voice_transpose (model, voices, roll.transpose)
+      if options["cache"] and roll.digest:
+         options["cache"].store (roll.digest, key, roll.transpose)
+   elif len (transpose) == 1:
+      roll.transpose = transpose[0]
+   else:
+      roll.transpose = transpose
+
+
+def compare_models (roll, options, names=None):
+   # Score the roll on every box model. Parsing, filtering, the histogram
+   # and the pitch index are shared, per model only the transposition
+   # search and the band are computed. Returns a row per model, best first.
+   mindelta = roll.min_repetition ()
+   rows = []
+   for name in names or sorted (options["models"]):
+      model = options["models"][name]
+      with contextlib.redirect_stdout (io.StringIO ()):
+         set_transpose (roll, model, dict (options, top=1))
+      notelist = roll.get_compat_band (model)
+      dropped, merged = band_losses (roll.band_sources (), model)
+      rows.append ({ "box"        : name,
+                     "transpose"  : roll.transpose,
+                     "unplayable" : roll.unplayable (model),
+                     "dropped"    : dropped,
+                     "merged"     : merged,
+                     "holes"      : sum (map (len, notelist)),
+                     "length"     : strip_length (model, notelist, mindelta) })
+   rows.sort (key=lambda r: (r["unplayable"] + r["dropped"] + r["merged"],
+                             r["length"]))
+   return rows
+
+
+def format_transpose (t):
+   return "%+d" % t if isinstance (t, int) else ",".join ("%+d" % i for i in t)
+
+
+def print_models (rows):
+   print ("%-12s %9s %10s %7s %6s %6s %9s" % ("box", "transpose", "unplayable",
+                                             "dropped", "merged", "holes", "length/mm"))
+   for r in rows:
+      print ("%-12s %9s %10d %7d %6d %6d %9.1f" % (r["box"],
+             format_transpose (r["transpose"]),
+             r["unplayable"], r["dropped"], r["merged"], r["holes"], r["length"]))
+   print ("best fit: %s" % rows[0]["box"])
+
+
+def compare_filters (roll, options, deltas):
+   # Try several filter deltas on the box in options. The roll is parsed
+   # once, a session keeps the sorted notes between the filters. Returns
+   # a row per delta.
+   model = options["models"][options["box"]]
+   session = RollSession (roll)
+   rows = []
+   for delta in deltas:
+      filtered = session.filter (delta)
+      with contextlib.redirect_stdout (io.StringIO ()):
+         set_transpose (roll, model, dict (options, filter=delta, top=1))
+      notelist = session.band (model)
+      dropped, merged = band_losses (roll.band_sources (), model)
+      rows.append ({ "box"        : options["box"],
+                     "filter"     : delta,
+                     "filtered"   : filtered,
+                     "transpose"  : roll.transpose,
+                     "unplayable" : roll.unplayable (model),
+                     "dropped"    : dropped,
+                     "merged"     : merged,
+                     "holes"      : sum (map (len, notelist)) })
+   return rows
+
+
+def print_filters (rows):
+   print ("%8s %8s %9s %10s %7s %6s %6s" % ("filter", "filtered", "transpose",
+                                           "unplayable", "dropped", "merged", "holes"))
+   for r in rows:
+      print ("%8d %8d %9s %10d %7d %6d %6d" % (r["filter"], r["filtered"],
+             format_transpose (r["transpose"]),
+             r["unplayable"], r["dropped"], r["merged"], r["holes"]))
+
+
+def convert_file (filename, options):
+   # The whole pipeline for one file. All state is local, so this can run
+   # for many files in one process. Returns a summary dict, with the
+   # stats of every stage if options["stats"] is set. options["analyze"]
+   # stops after the band, before any layout or output.
+   model = options["models"][options["box"]]
+   summary = { "file" : filename, "box" : options["box"] }
+   stats = StageStats (options["stats"])
+
+   roll, mi, filtered = load_roll (filename, options, stats)
+   summary["notes"] = len (roll)
+   summary["filtered"] = filtered
+   stats.count (events=mi.events, notes=len (roll), filtered=filtered)
+
+   with stats.stage ("transpose"):
+      set_transpose (roll, model, options)
+
+   def band ():
+      notelist = roll.get_compat_band (model)
+      mindelta = roll.min_repetition ()
+      mingap = recovery_ticks (model, mindelta)
+      collisions = len (tine_collisions (notelist, mingap))
+      dropped, merged = band_losses (roll.band_sources (), model)
+      repair = None
+      if options["repair"]:
+         notelist, repair = repair_band (roll.band_sources (), model, mindelta)
+         # the counts are those of the repaired band, the ones found
+         # before go with the report
+         repair["before"] = { "dropped" : dropped, "merged" : merged,
+                              "collisions" : collisions }
+         dropped += repair["dropped"]
+         merged -= repair["unmerged"]
+         collisions = len (tine_collisions (notelist, mingap))
+      return (notelist, mindelta, (dropped, merged),
+              roll.unplayable (model), collisions, repair)
+
+   key = ("band", model.key, options["filter"], roll.transpose, roll.transpose_by,
+          options["repair"])
+   with stats.stage ("band"):
+      (notelist, mindelta, (dropped, merged), unplayable,
+       collisions, repair) = cached (options["cache"], roll.digest, key, band,
+                                     lambda value: len (value) == 6 and
+                                                   len (value[0]) == len (model.notes) and
+                                                   len (value[2]) == 2)
+   summary["transpose"] = roll.transpose
+   summary["unplayable"] = unplayable
+   summary["dropped"] = dropped
+   summary["merged"] = merged
+   summary["collisions"] = collisions
+   if repair:
+      summary["repair"] = repair
+   summary["holes"] = sum (map (len, notelist))
+   stats.count (holes=summary["holes"])
+
+   if repair:
+      if repair["before"]["collisions"]:
+         print ("%d holes too close to the one before on their tine" %
+                repair["before"]["collisions"])
+      print ("repaired: %d refolded, %d nudged, %d dropped" %
+             (repair["refolded"], repair["nudged"], repair["dropped"]))
+   if collisions:
+      print ("%d holes %stoo close to the one before on their tine" %
+             (collisions, "still " if repair else ""))
+
+   if options["analyze"]:
+      print ("unplayable: %d, dropped: %d, merged: %d, collisions: %d, holes: %d, shortest repetition: %d ticks" %
+             (unplayable, dropped, merged, collisions, summary["holes"], mindelta))
+      if stats.enabled:
+         summary["stats"] = stats.result ()
+      return summary
+
+   if any (options[kind] for kind in ("pdf", "svg", "gcode", "dxf", "preview",
+                                      "thumbnail")):
+      with stats.stage ("layout"):
+         used = paper_usage (model, notelist, mindelta, options["split"])
+         greedy = paper_usage (model, notelist, mindelta, "greedy")
+      summary["strips"] = used["strips"]
+      summary["pages"] = used["pages"]
+      stats.count (strips=used["strips"], pages=used["pages"])
+      line = "strips: %d, pages: %d" % (used["strips"], used["pages"])
+      if greedy["fits"]:
+         # compared to breaking each strip in the last wide gap that fits,
+         # unless that layout is not possible on the page at all
+         summary["saved"] = dict ((k, greedy[k] - used[k])
+                                  for k in ("strips", "pages", "cuts"))
+         line += ", saved %d strips, %d pages, %.0fmm of cuts" % (
+                    summary["saved"]["strips"], summary["saved"]["pages"],
+                    summary["saved"]["cuts"])
+      if not used["fits"]:
+         line += ", some strips are longer than the page"
+      print (line)
+
+   outputs = {}
+   if options["midi"]:
+      outputs["midi"] = output_name (options["midi"], filename)
+      with stats.stage ("midi"):
+         output_midi (model, outputs["midi"], notelist, mindelta, mi.timediv,
+                      mi.tempo)
+   if options["wav"]:
+      outputs["wav"] = output_name (options["wav"], filename)
+      with stats.stage ("wav"):
+         output_wav (model, outputs["wav"], notelist, mi.timediv, mi.tempo)
+
+   for kind, is_pdf in (("pdf", True), ("svg", False)):
+      if not options[kind]:
+         continue
+      outputs[kind] = output_name (options[kind], filename)
+      with stats.stage (kind):
+         if options["render"] == "direct":
+            output_file_direct (model, outputs[kind], is_pdf, notelist, mindelta,
+                                options["jobs"], options["split"])
+         else:
+            output_file (model, outputs[kind], is_pdf, notelist, mindelta,
+                         options["split"])
+   if options["preview"]:
+      outputs["preview"] = output_name (options["preview"], filename)
+      with stats.stage ("preview"):
+         output_preview (model, outputs["preview"], notelist, mindelta,
+                         options["guides"], options["split"])
+   if options["thumbnail"]:
+      # the first page for a contact sheet, taken out of the summary by main
+      with stats.stage ("thumbnail"):
+         summary["thumbnail"] = render_preview (model, notelist, mindelta,
+                                                preview["thumbnail"], options["guides"],
+                                                options["split"], paper["height"])
+   for kind, is_gcode in (("gcode", True), ("dxf", False)):
+      if not options[kind]:
+         continue
+      outputs[kind] = output_name (options[kind], filename)
+      with stats.stage (kind):
+         summary["laser"] = output_laser (model, outputs[kind], is_gcode, notelist,
+                                          mindelta, options["split"])
+      print ("laser: cut %.0fmm, travel %.0fmm (%.0fmm in time order), about %.0f min" %
+             (summary["laser"]["cut"], summary["laser"]["travel"],
+              summary["laser"]["time_order"], summary["laser"]["time"] / 60))
+   summary["outputs"] = outputs
+
+   if stats.enabled:
+      summary["stats"] = stats.result ()
+
+   return summary
+
+
+def convert_quietly (filename, options):
+   # batch worker: no console chatter, errors end up in the summary
+   try:
+      with contextlib.redirect_stdout (io.StringIO ()):
+         return convert_file (filename, options)
+   except Exception as e:
+      return { "file" : filename, "box" : options["box"],
+               "error" : "%s: %s" % (type (e).__name__, e) }
+
+
+def convert_batch (filenames, options, jobs=None):
+   # one worker process per core, summaries in the order of filenames
+   import concurrent.futures
+   with concurrent.futures.ProcessPoolExecutor (max_workers=jobs) as pool:
+      return list (pool.map (convert_quietly, filenames,
+                             [options] * len (filenames)))
+
+
+class FileWatcher (object):
+   # Waits for a file to change. Uses inotify on Linux, on the directory
+   # so that editors replacing the file are noticed as well. Elsewhere
+   # the modification time is polled.
+
+   IN_CLOSE_WRITE = 0x08
+   IN_MOVED_TO    = 0x80
+
+   def __init__ (self, filename, interval=0.5):
+      self.filename = os.path.abspath (filename)
+      self.interval = interval
+      self.stamp = self.file_stamp ()
+      self.fd = None
+      try:
+         import ctypes, ctypes.util
+         libc = ctypes.CDLL (ctypes.util.find_library ("c"), use_errno=True)
+         fd = libc.inotify_init ()
+         if fd >= 0:
+            directory = os.path.dirname (self.filename).encode ()
+            if libc.inotify_add_watch (fd, directory,
+                                       self.IN_CLOSE_WRITE | self.IN_MOVED_TO) >= 0:
+               self.fd = fd
+            else:
+               os.close (fd)
+      except (OSError, AttributeError, TypeError):
+         pass
+
 
+   def file_stamp (self):
+      try:
+         st = os.stat (self.filename)
+      except OSError:
+         return None
+      return st.st_mtime_ns, st.st_size
+
+
+   def events (self):
+      # names of the files in the directory that were written
+      data = os.read (self.fd, 65536)
+      pos = 0
+      while pos < len (data):
+         wd, mask, cookie, length = struct.unpack_from ("iIII", data, pos)
+         pos += 16
+         yield data[pos:pos + length].rstrip (b"\0")
+         pos += length
+
+
+   def wait (self):
+      # returns once the file has changed
+      name = os.path.basename (self.filename).encode ()
+      while True:
+         if self.fd is not None:
+            if name not in self.events ():
+               continue
+         else:
+            time.sleep (self.interval)
+         stamp = self.file_stamp ()
+         if stamp is not None and stamp != self.stamp:
+            self.stamp = stamp
+            return
+
+
+def watch_file (filename, options):
+   # Convert the file, then again whenever it changes, until interrupted.
+   # The parsed tracks are kept, only changed tracks are parsed again.
+   options = dict (options, tracks={})
+   watcher = FileWatcher (filename)
+   while True:
+      start = time.time ()
+      try:
+         convert_file (filename, options)
+         print ("done in %.2fs, waiting for %s to change" % (time.time () - start, filename))
+      except Exception as e:
+         sys.stderr.write ("%s: %s\n" % (filename, e))
+      sys.stdout.flush ()
+      watcher.wait ()
+
+
+def convert_upload (data, options, kind):
+   # Server worker: convert the contents of a midi file. Returns the
+   # summary and the contents of the output of the given kind (pdf, svg,
+   # midi, wav, gcode, dxf or preview).
+   import tempfile
+   with tempfile.TemporaryDirectory () as tmp:
+      filename = os.path.join (tmp, "upload.mid")
+      with open (filename, "wb") as f:
+         f.write (data)
+      options = dict (options, **{ kind : os.path.join (tmp, "output") })
+      with contextlib.redirect_stdout (io.StringIO ()), \
+           contextlib.redirect_stderr (io.StringIO ()):
+         summary = convert_file (filename, options)
+      with open (options[kind], "rb") as f:
+         return summary, f.read ()
+
+
+upload_form = """<!DOCTYPE html>
+<html><head><title>lamusica</title></head><body>
+<form method="post" action="/convert" enctype="multipart/form-data">
+<p>MIDI file: <input type="file" name="midi"></p>
+<p>Box: <select name="box">%s</select></p>
+<p>Filter (ticks): <input name="filter" value="1"></p>
+<p>Transpose (empty for automatic): <input name="transpose"></p>
+<p><label><input type="checkbox" name="repair" value="1"> Repair tine collisions</label></p>
+<p>Output: <select name="format">%s</select></p>
+<p><input type="submit" value="Convert"></p>
+</form></body></html>
+"""
+
+
+class ConversionServer (object):
+   # A small HTTP server converting uploaded midi files. POST /convert
+   # with the midi file as the body or as the "midi" field of a multipart
+   # form, the parameters box, filter, transpose, cost, voices, repair and
+   # format in the query or the form. The response is the output file, its
+   # summary in the X-Summary header. GET / shows a form.
+   #
+   # The conversions run in a process pool, the workers stay warm between
+   # requests. Up to jobs requests are converted at once, queue more wait
+   # for a worker, beyond that the server answers 503.
+
+   max_upload = 16 << 20
+   timeout = 30
+   formats = {
+      "pdf"     : "application/pdf",
+      "svg"     : "image/svg+xml",
+      "midi"    : "audio/midi",
+      "wav"     : "audio/wav",
+      "gcode"   : "text/plain",
+      "dxf"     : "image/vnd.dxf",
+      "preview" : "image/png",
+   }
+   reasons = { 200 : "OK", 400 : "Bad Request", 404 : "Not Found",
+               405 : "Method Not Allowed", 408 : "Request Timeout",
+               413 : "Payload Too Large", 422 : "Unprocessable Entity",
+               500 : "Internal Server Error", 503 : "Service Unavailable" }
+
+   def __init__ (self, options, jobs=None, queue=16):
+      # pages are not rendered in parallel, the requests are
+      self.options = dict (options, jobs=1, tracks=None)
+      self.jobs = jobs or os.cpu_count () or 1
+      self.queue = queue
+      self.pending = 0
+      self.pool = None
+
+
+   def serve (self, host, port):
+      import asyncio, concurrent.futures
+      with concurrent.futures.ProcessPoolExecutor (self.jobs) as pool:
+         self.pool = pool
+         asyncio.run (self.run (host, port))
+
+
+   async def run (self, host, port):
+      import asyncio
+      server = await asyncio.start_server (self.handle, host, port)
+      print ("serving on http://%s:%d/ with %d workers" % (host, port, self.jobs))
+      sys.stdout.flush ()
+      async with server:
+         await server.serve_forever ()
+
+
+   async def handle (self, reader, writer):
+      import asyncio
+      try:
+         # only reading the request is timed, a conversion keeps its worker
+         # until it is done
+         request = await asyncio.wait_for (self.read_request (reader), self.timeout)
+         status, headers, body = await self.respond (*request)
+      except asyncio.TimeoutError:
+         status, headers, body = self.error (408, "request timed out")
+      except asyncio.IncompleteReadError as e:
+         # the client closed before sending all of the body
+         status, headers, body = self.error (400, "request body has %d of %d bytes" %
+                                             (len (e.partial), e.expected))
+      except (ValueError, KeyError) as e:
+         status, headers, body = self.error (400, str (e))
+      except Exception as e:
+         status, headers, body = self.error (500, "%s: %s" % (type (e).__name__, e))
+
+      head = ["HTTP/1.1 %d %s" % (status, self.reasons[status]),
+              "Content-Length: %d" % len (body), "Connection: close"]
+      head += ["%s: %s" % h for h in headers]
+      try:
+         writer.write (("\r\n".join (head) + "\r\n\r\n").encode ("latin-1") + body)
+         await writer.drain ()
+         writer.close ()
+      except ConnectionError:
+         pass
+
+
+   def error (self, status, message):
+      return status, [("Content-Type", "text/plain")], (message + "\n").encode ()
+
+
+   async def read_request (self, reader):
+      # method, url, lower case headers and body of a request
+      import urllib.parse
+      method, target, version = (await reader.readline ()).decode ("latin-1").split ()
+      headers = {}
+      while True:
+         line = await reader.readline ()
+         if line in (b"\r\n", b"\n", b""):
+            break
+         key, _, value = line.decode ("latin-1").partition (":")
+         headers[key.strip ().lower ()] = value.strip ()
+
+      length = int (headers.get ("content-length", 0))
+      if length > self.max_upload:
+         # not read, the response goes out right away
+         return method, urllib.parse.urlsplit (target), headers, None
+      return method, urllib.parse.urlsplit (target), headers, await reader.readexactly (length)
+
+
+   async def respond (self, method, url, headers, data):
+      import asyncio, email.parser, email.policy, json, urllib.parse
+      if url.path == "/" and method == "GET":
+         boxes = sorted (self.options["models"])
+         page = upload_form % ("".join ("<option>%s</option>" % m for m in boxes),
+                               "".join ("<option>%s</option>" % f for f in self.formats))
+         return 200, [("Content-Type", "text/html; charset=utf-8")], page.encode ()
+      if url.path != "/convert":
+         return self.error (404, "not found")
+      if method != "POST":
+         return self.error (405, "use POST")
+
+      if data is None:
+         return self.error (413, "upload larger than %d bytes" % self.max_upload)
+
+      params = dict (urllib.parse.parse_qsl (url.query))
+      ctype = headers.get ("content-type", "")
+      if ctype.startswith ("multipart/form-data"):
+         form = email.parser.BytesParser (policy=email.policy.HTTP).parsebytes (
+                   b"Content-Type: " + ctype.encode ("latin-1") + b"\r\n\r\n" + data)
+         data = b""
+         for part in form.iter_parts ():
+            name = part.get_param ("name", header="content-disposition")
+            value = part.get_payload (decode=True) or b""
+            if name == "midi":
+               data = value
+            elif name:
+               params[name] = value.decode ("utf-8")
+
+      options, kind = self.request_options (params)
+      if self.pending >= self.jobs + self.queue:
+         return self.error (503, "too many requests, try again later")
+
+      # the slot is given back when the worker is done, even if this
+      # handler does not wait for it any more
+      self.pending += 1
+      future = asyncio.get_running_loop ().run_in_executor (
+                  self.pool, convert_upload, data, options, kind)
+      future.add_done_callback (self.release)
+      try:
+         summary, output = await asyncio.shield (future)
+      except Exception as e:
+         return self.error (422, "%s: %s" % (type (e).__name__, e))
+
+      summary.pop ("file", None)
+      summary.pop ("outputs", None)
+      return 200, [("Content-Type", self.formats[kind]),
+                   ("X-Summary", json.dumps (summary))], output
+
+
+   def release (self, future):
+      self.pending -= 1
+
+
+   def request_options (self, params):
+      # the conversion options for a request, the defaults are the ones
+      # given on the command line
+      options = dict (self.options, midi=None, wav=None, pdf=None, svg=None,
+                      gcode=None, dxf=None, preview=None, thumbnail=False)
+      kind = params.get ("format", "pdf")
+      if kind not in self.formats:
+         raise ValueError ("unknown format %s" % kind)
+      if params.get ("box"):
+         if params["box"] not in options["models"]:
+            raise ValueError ("unknown box %s" % params["box"])
+         options["box"] = params["box"]
+      if params.get ("filter"):
+         options["filter"] = int (params["filter"])
+      if params.get ("transpose"):
+         options["transpose"] = [ int (t) for t in params["transpose"].split (",") ]
+      if params.get ("cost"):
+         if params["cost"] not in transpose_costs:
+            raise ValueError ("unknown cost %s" % params["cost"])
+         options["cost"] = params["cost"]
+      if params.get ("voices"):
+         if params["voices"] not in ("track", "channel"):
+            raise ValueError ("voices must be track or channel")
+         options["voices"] = params["voices"]
+      if params.get ("repair"):
+         options["repair"] = params["repair"] not in ("0", "no", "false", "off")
+      return options, kind
+
+
+def midi_files (directory):
+   return sorted (os.path.join (directory, f) for f in os.listdir (directory)
+                  if f.lower ().endswith ((".mid", ".midi")))
+
+
+def write_summary (summaries, filename):
+   import json
+   data = json.dumps (summaries, indent=2) + "\n"
+   if filename == "-":
+      sys.stdout.write (data)
+   else:
+      with open (filename, "w") as f:
+         f.write (data)
 
 
 if __name__=='__main__':
    try:
-      opts, args = getopt.getopt (sys.argv[1:],
-                                  "ht:f:b:m:s:p:",
+      opts, args = getopt.gnu_getopt (sys.argv[1:],
+                                  "ht:f:b:m:s:p:g:r:c:k:v:j:",
                                   ["help", "transpose=",
                                   "filter=", "box=",
-                                  "midi=", "svg=", "pdf="])
+                                  "midi=", "svg=", "pdf=", "gcode=", "dxf=",
+                                  "preview=", "guides", "wav=",
+                                  "render=", "split=",
+                                  "cost=", "top=", "voices=",
+                                  "batch=", "jobs=", "summary=",
+                                  "cache=", "cache-size=",
+                                  "filters=", "all-boxes", "watch",
+                                  "listen=", "queue=",
+                                  "stats", "profile=", "trace-memory=",
+                                  "analyze", "repair", "models="])
    except getopt.GetoptError as err:
       usage()
       sys.exit (2)
 
-   if len (args) != 1:
-      usage()
-      sys.exit (2)
-
    midifile = None
+   wavfile = None
    svgfile = None
    pdffile = None
+   gcodefile = None
+   dxffile = None
+   previewfile = None
+   guides = False
+   render = "cairo"
+   split = "optimal"
    filter = 1
    boxtype = "sankyo20"
    transpose = None
+   cost = "unplayable"
+   top = 1
+   voices = None
+   batchdir = None
+   jobs = None
+   summaryfile = None
+   cachedir = None
+   cachesize = 256
+   all_boxes = False
+   filters = None
+   watch = False
+   listen = "127.0.0.1:8000"
+   queue = 16
+   stats = False
+   analyze = False
+   repair = False
+   profile = None
+   trace_memory = None
+   boxes = models
 
    for o, a in opts:
       if o in ("-h", "--help"):
@@ -627,39 +3201,195 @@ if __name__=='__main__':
          boxtype = a
       elif o in ("-m", "--midi"):
          midifile = a
+      elif o == "--wav":
+         wavfile = a
       elif o in ("-s", "--svg"):
          svgfile = a
       elif o in ("-p", "--pdf"):
          pdffile = a
+      elif o in ("-g", "--gcode"):
+         gcodefile = a
+      elif o == "--dxf":
+         dxffile = a
+      elif o == "--preview":
+         previewfile = a
+      elif o == "--guides":
+         guides = True
+      elif o in ("-r", "--render"):
+         if a not in ("cairo", "direct"):
+            usage()
+            sys.exit (2)
+         render = a
+      elif o == "--split":
+         if a not in split_methods:
+            usage()
+            sys.exit (2)
+         split = a
+      elif o in ("-c", "--cost"):
+         if a not in transpose_costs:
+            usage()
+            sys.exit (2)
+         cost = a
+      elif o in ("-k", "--top"):
+         top = int (a)
+      elif o in ("-v", "--voices"):
+         if a not in ("track", "channel"):
+            usage()
+            sys.exit (2)
+         voices = a
+      elif o == "--batch":
+         batchdir = a
+      elif o in ("-j", "--jobs"):
+         jobs = int (a)
+      elif o == "--summary":
+         summaryfile = a
+      elif o == "--cache":
+         cachedir = a
+      elif o == "--cache-size":
+         cachesize = int (a)
+      elif o == "--all-boxes":
+         all_boxes = True
+      elif o == "--filters":
+         filters = [ int (f) for f in a.split (",") ]
+      elif o == "--watch":
+         watch = True
+      elif o == "--listen":
+         listen = a
+      elif o == "--queue":
+         queue = int (a)
+      elif o == "--stats":
+         stats = True
+      elif o == "--analyze":
+         analyze = True
+      elif o == "--repair":
+         repair = True
+      elif o == "--profile":
+         profile = a
+      elif o == "--trace-memory":
+         trace_memory = a
+      elif o == "--models":
+         try:
+            boxes = dict (boxes, **load_models (a))
+         except Exception as e:
+            sys.stderr.write ("%s: %s\n" % (a, e))
+            sys.exit (2)
       else:
          assert False, "unhandled option"
 
-   model = models.get (boxtype, None)
-   if not model:
-      sys.stderr.write("Boxtype unknown. Available boxtypes are:")
-      ms = models.keys ()
-      ms.sort ()
-      sys.stderr.write( "  * %s" % "\n  * ".join (ms))
-      sys.exit (2)
+   if batchdir:
+      args += midi_files (batchdir)
 
-   roll = PianoRoll()
-   mi = MidiImporter (roll)
-   mi.import_file (args[0])
-
-   roll.filter_repetition (filter)
+   if not args or (len (args) > 1 and
+                   any (f and "%s" not in f
+                        for f in (midifile, wavfile, pdffile, svgfile, gcodefile,
+                                  dxffile))):
+      # several input files need %s in the output names
+      usage()
+      sys.exit (2)
 
-   if transpose == None:
-      roll.transpose = roll.find_transpose ([model["lowest"] + i for i in model["notes"]])
-   else:
-      roll.transpose = transpose
+   # several files and one preview: the contact sheet
+   sheetfile = None
+   if len (args) > 1 and previewfile and "%s" not in previewfile:
+      sheetfile, previewfile = previewfile, None
 
-   notelist = roll.get_compat_band (model)
-   mindelta = roll.min_repetition ()
+   if analyze and any ((midifile, wavfile, pdffile, svgfile, gcodefile, dxffile,
+                        previewfile, sheetfile)):
+      # analysis writes nothing
+      usage()
+      sys.exit (2)
 
-   if midifile:
-      output_midi (model, midifile, notelist, mindelta)
+   if boxtype not in boxes:
+      sys.stderr.write("Boxtype unknown. Available boxtypes are:\n")
+      sys.stderr.write( "  * %s\n" % "\n  * ".join (sorted (boxes)))
+      sys.exit (2)
 
-   if pdffile:
-      output_file (model, pdffile, True, notelist, mindelta)
-   if svgfile:
-      output_file (model, svgfile, False, notelist, mindelta)
+   options = { "box"       : boxtype,
+               "models"    : boxes,
+               "filter"    : filter,
+               "transpose" : transpose,
+               "cost"      : cost,
+               "top"       : top,
+               "voices"    : voices,
+               "midi"      : midifile,
+               "wav"       : wavfile,
+               "pdf"       : pdffile,
+               "svg"       : svgfile,
+               "gcode"     : gcodefile,
+               "dxf"       : dxffile,
+               "preview"   : previewfile,
+               "thumbnail" : bool (sheetfile),
+               "guides"    : guides,
+               "render"    : render,
+               "split"     : split,
+               "cache"     : cachedir and RollCache (cachedir, cachesize << 20),
+               "tracks"    : None,
+               "stats"     : stats,
+               "analyze"   : analyze,
+               "repair"    : repair,
+               # pages are only rendered in parallel for a single file
+               "jobs"      : jobs if len (args) == 1 else 1 }
+
+   if args == ["serve"]:
+      host, _, port = listen.rpartition (":")
+      try:
+         ConversionServer (options, jobs, queue).serve (host or "127.0.0.1", int (port))
+      except KeyboardInterrupt:
+         sys.exit ()
+
+   if watch:
+      if len (args) != 1 or args[0] == "-" or all_boxes or filters:
+         usage()
+         sys.exit (2)
+      try:
+         watch_file (args[0], options)
+      except KeyboardInterrupt:
+         sys.exit ()
+
+   if all_boxes or filters:
+      if len (args) != 1 or (all_boxes and filters):
+         usage()
+         sys.exit (2)
+
+   if profile:
+      import cProfile
+      profiler = cProfile.Profile ()
+      profiler.enable ()
+   if trace_memory:
+      import tracemalloc
+      tracemalloc.start (25)
+
+   if all_boxes or filters:
+      roll, mi, filtered = load_roll (args[0], options)
+      if all_boxes:
+         summaries = compare_models (roll, options)
+         print_models (summaries)
+      else:
+         summaries = compare_filters (roll, options, filters)
+         print_filters (summaries)
+   elif len (args) == 1:
+      summaries = [convert_file (args[0], options)]
+   else:
+      summaries = convert_batch (args, options, jobs)
+      for r in summaries:
+         if "error" in r:
+            sys.stderr.write ("%s: %s\n" % (r["file"], r["error"]))
+
+   if profile:
+      profiler.disable ()
+      profiler.dump_stats (profile)
+   if trace_memory:
+      tracemalloc.take_snapshot ().dump (trace_memory)
+      tracemalloc.stop ()
+
+   if sheetfile:
+      write_contact_sheet (sheetfile, [r.pop ("thumbnail", None) for r in summaries])
+
+   for r in summaries:
+      if "stats" in r:
+         print_stats (r)
+
+   if summaryfile:
+      write_summary (summaries, summaryfile)
+
+   if any ("error" in r for r in summaries):
+      sys.exit (1)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Load test for "lamusica.py serve": several clients post the same midi
+# file for a while, then throughput and latencies are printed.
+
+import sys, getopt, time, json
+import concurrent.futures, http.client, urllib.parse
+
+
+def usage ():
+   sys.stderr.write( "Usage: %s [arguments] <midi-file>\n" % sys.argv[0])
+   sys.stderr.write( "  -h, --help: show usage\n")
+   sys.stderr.write( "  -u, --url=url: server url (default: http://127.0.0.1:8000/convert?format=pdf)\n")
+   sys.stderr.write( "  -c, --clients=number: concurrent clients (default: 8)\n")
+   sys.stderr.write( "  -d, --duration=seconds: length of the test (default: 10)\n")
+   sys.stderr.write( "      --json: print the results as JSON\n")
+
+
+def client (url, data, deadline):
+   # post until the deadline, returns (status, seconds) per request
+   results = []
+   while time.time () < deadline:
+      start = time.time ()
+      conn = http.client.HTTPConnection (url.hostname, url.port or 80, timeout=60)
+      try:
+         conn.request ("POST", url.path + ("?" + url.query if url.query else ""),
+                       body=data, headers={ "Content-Type" : "audio/midi" })
+         response = conn.getresponse ()
+         response.read ()
+         status = response.status
+      except OSError:
+         status = 0
+      finally:
+         conn.close ()
+      results.append ((status, time.time () - start))
+      if status == 503:
+         # the queue is full, back off a little
+         time.sleep (0.05)
+   return results
+
+
+def percentile (values, p):
+   if not values:
+      return 0.0
+   return values[min (len (values) - 1, int (len (values) * p))]
+
+
+def load_test (url, data, clients, duration):
+   deadline = time.time () + duration
+   start = time.time ()
+   with concurrent.futures.ThreadPoolExecutor (clients) as pool:
+      runs = list (pool.map (client, [url] * clients, [data] * clients,
+                             [deadline] * clients))
+   elapsed = time.time () - start
+
+   results = [r for run in runs for r in run]
+   ok = sorted (t for status, t in results if status == 200)
+   statuses = {}
+   for status, t in results:
+      statuses[status] = statuses.get (status, 0) + 1
+   return { "clients"    : clients,
+            "seconds"    : elapsed,
+            "requests"   : len (results),
+            "ok"         : len (ok),
+            "statuses"   : statuses,
+            "throughput" : len (ok) / elapsed,
+            "latency"    : { "p50" : percentile (ok, 0.5),
+                             "p90" : percentile (ok, 0.9),
+                             "p99" : percentile (ok, 0.99),
+                             "max" : ok[-1] if ok else 0.0 } }
+
+
+if __name__=='__main__':
+   try:
+      opts, args = getopt.gnu_getopt (sys.argv[1:], "hu:c:d:",
+                                      ["help", "url=", "clients=", "duration=",
+                                       "json"])
+   except getopt.GetoptError as err:
+      usage()
+      sys.exit (2)
+
+   url = "http://127.0.0.1:8000/convert?format=pdf"
+   clients = 8
+   duration = 10.0
+   as_json = False
+
+   for o, a in opts:
+      if o in ("-h", "--help"):
+         usage()
+         sys.exit()
+      elif o in ("-u", "--url"):
+         url = a
+      elif o in ("-c", "--clients"):
+         clients = int (a)
+      elif o in ("-d", "--duration"):
+         duration = float (a)
+      elif o == "--json":
+         as_json = True
+      else:
+         assert False, "unhandled option"
+
+   if len (args) != 1:
+      usage()
+      sys.exit (2)
+
+   with open (args[0], "rb") as f:
+      data = f.read ()
+
+   r = load_test (urllib.parse.urlsplit (url), data, clients, duration)
+   if as_json:
+      print (json.dumps (r, indent=2))
+   else:
+      print ("%d requests in %.1fs, %d ok, statuses %s" %
+             (r["requests"], r["seconds"], r["ok"],
+              ", ".join ("%s: %d" % s for s in sorted (r["statuses"].items ()))))
+      print ("throughput: %.1f conversions/s" % r["throughput"])
+      print ("latency: p50 %.3fs, p90 %.3fs, p99 %.3fs, max %.3fs" %
+             (r["latency"]["p50"], r["latency"]["p90"],
+              r["latency"]["p99"], r["latency"]["max"]))
+
+   if r["ok"] == 0:
+      sys.exit (1)
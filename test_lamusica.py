@@ -0,0 +1,725 @@
+# Regression tests for lamusica.py, run with "python3 -m pytest".
+
+import os, io, json, hashlib, itertools, math, struct, time, contextlib
+
+import pytest
+
+import lamusica
+from bench import vlq, synth_midi
+
+
+here = os.path.dirname (os.path.abspath (__file__))
+es_ist = os.path.join (here, "es_ist.midi")
+
+
+def import_roll (filename, roll_class=lamusica.CompactPianoRoll):
+   roll = roll_class ()
+   mi = lamusica.MidiImporter (roll)
+   with contextlib.redirect_stderr (io.StringIO ()):
+      mi.import_file (filename)
+   return roll, mi
+
+
+def note_tuples (roll):
+   return [(n.note, n.ticks, n.channel, n.track, n.duration) for n in roll.notes]
+
+
+def band_of (roll, model):
+   roll.filter_repetition (1)
+   with contextlib.redirect_stdout (io.StringIO ()):
+      roll.transpose = roll.find_transpose ([model["lowest"] + i for i in model["notes"]])
+   return [list (ticks) for ticks in roll.get_compat_band (model)]
+
+
+def digest (value):
+   return hashlib.sha256 (json.dumps (value).encode ()).hexdigest ()[:16]
+
+
+def write_midi (path, tracks, timediv=480):
+   # tracks are the event bytes without the end of track meta event
+   data = struct.pack (">4sIhhh", b"MThd", 6, 1, len (tracks), timediv)
+   for events in tracks:
+      events = events + vlq (0) + b"\xff\x2f\x00"
+      data += b"MTrk" + struct.pack (">I", len (events)) + events
+   with open (path, "wb") as f:
+      f.write (data)
+   return str (path)
+
+
+# es_ist.midi per model: transposition, holes, shortest repetition and a
+# digest of the band, as computed by the original implementation
+es_ist_bands = {
+   "sankyo15"  : (8, 269, 512, "fb84b9f49fb09ba5"),
+   "sankyo20"  : (0, 271, 512, "531bd00d119441a4"),
+   "sankyo33"  : (5, 286, 512, "7048ed7de6d2861e"),
+   "teanola30" : (0, 284, 512, "cae852fa2f8e9b5a"),
+}
+
+
+def test_es_ist_notes ():
+   roll, mi = import_roll (es_ist, lamusica.PianoRoll)
+   compact, _ = import_roll (es_ist)
+   assert len (roll.notes) == 286
+   assert mi.timediv == 1024
+   assert digest ([t[:4] for t in note_tuples (roll)]) == "68a6f588e1ab5844"
+   assert note_tuples (compact) == note_tuples (roll)
+
+
+@pytest.mark.parametrize ("box", sorted (es_ist_bands))
+def test_es_ist_band (box):
+   model = lamusica.models[box]
+   transpose, holes, mindelta, band_digest = es_ist_bands[box]
+   for roll_class in (lamusica.PianoRoll, lamusica.CompactPianoRoll):
+      roll, mi = import_roll (es_ist, roll_class)
+      band = band_of (roll, model)
+      assert roll.transpose == transpose
+      assert sum (map (len, band)) == holes
+      assert roll.min_repetition () == mindelta
+      assert digest (band) == band_digest
+
+
+def test_running_status (tmp_path):
+   # the same notes with and without running status
+   explicit = vlq (0) + b"\x90\x3c\x40" + vlq (96) + b"\x80\x3c\x00" + \
+              vlq (0) + b"\x90\x40\x40" + vlq (96) + b"\x90\x40\x00"
+   running = vlq (0) + b"\x90\x3c\x40" + vlq (96) + b"\x3c\x00" + \
+             vlq (0) + b"\x40\x40" + vlq (96) + b"\x40\x00"
+   a, _ = import_roll (write_midi (tmp_path / "explicit.mid", [explicit]))
+   b, _ = import_roll (write_midi (tmp_path / "running.mid", [running]))
+   assert note_tuples (a) == note_tuples (b) == [(60, 0, 0, 0, 96), (64, 96, 0, 0, 96)]
+
+   # a generated piece, encoded both ways
+   path_a = tmp_path / "a.mid"
+   path_b = tmp_path / "b.mid"
+   path_a.write_bytes (synth_midi (4, 300, running=False, meta=False))
+   path_b.write_bytes (synth_midi (4, 300, running=True, meta=False))
+   assert path_a.stat ().st_size > path_b.stat ().st_size
+   assert note_tuples (import_roll (str (path_a))[0]) == \
+          note_tuples (import_roll (str (path_b))[0])
+
+
+def test_running_status_without_status ():
+   roll = lamusica.CompactPianoRoll ()
+   mi = lamusica.MidiImporter (roll)
+   with pytest.raises (Exception, match="without running status"):
+      list (mi.iter_events (vlq (0) + b"\x3c\x40"))
+
+
+def test_import_event ():
+   # events fed one at a time give the notes with their durations, as
+   # the import of the whole track does; a note without note-off ends
+   # with the track
+   events = vlq (0) + b"\x90\x3c\x40" + vlq (48) + b"\x90\x40\x40" + \
+            vlq (48) + b"\x80\x3c\x00" + vlq (0) + b"\x90\x43\x40" + \
+            vlq (96) + b"\x80\x40\x00" + vlq (96) + b"\xff\x2f\x00"
+   expected = [(60, 0, 0, 0, 96), (64, 48, 0, 0, 144), (67, 96, 0, 0, 0)]
+   for roll_class in (lamusica.PianoRoll, lamusica.CompactPianoRoll):
+      roll = roll_class ()
+      mi = lamusica.MidiImporter (roll)
+      for ticks, command in mi.iter_events (events):
+         mi.import_event (ticks, 0, command)
+      assert note_tuples (roll) == expected
+      roll = roll_class ()
+      mi = lamusica.MidiImporter (roll)
+      mi.import_ticked_events (0, events)
+      assert note_tuples (roll) == expected
+
+
+@pytest.mark.parametrize ("length", [0, 127, 128, 200, 16383, 16384, 70000])
+def test_long_meta_and_sysex (tmp_path, length):
+   # meta and sysex events with multi-byte lengths between the notes,
+   # running status does not survive them
+   notes = vlq (0) + b"\x90\x3c\x40" + vlq (96) + b"\x80\x3c\x00"
+   events = vlq (0) + b"\xff\x03" + vlq (length) + b"t" * length + \
+            vlq (0) + b"\xf0" + vlq (length + 1) + b"\x7e" * length + b"\xf7" + \
+            notes + \
+            vlq (0) + b"\xff\x01" + vlq (length) + b"x" * length + \
+            vlq (10) + b"\x90\x40\x40" + vlq (96) + b"\x40\x00"
+   roll, mi = import_roll (write_midi (tmp_path / "meta.mid", [events]))
+   assert note_tuples (roll) == [(60, 0, 0, 0, 96), (64, 106, 0, 0, 96)]
+
+
+def test_meta_exceeding_track ():
+   mi = lamusica.MidiImporter (lamusica.CompactPianoRoll ())
+   with pytest.raises (Exception, match="exceeds end of track"):
+      list (mi.iter_events (vlq (0) + b"\xff\x01" + vlq (200) + b"x" * 100))
+
+
+def test_generated_with_meta (tmp_path):
+   path_a = tmp_path / "meta.mid"
+   path_b = tmp_path / "plain.mid"
+   path_a.write_bytes (synth_midi (3, 200, meta=True))
+   path_b.write_bytes (synth_midi (3, 200, meta=False))
+   assert note_tuples (import_roll (str (path_a))[0]) == \
+          note_tuples (import_roll (str (path_b))[0])
+
+
+def test_session_filter (tmp_path):
+   # a session goes from delta to delta by patching the filter bits and
+   # the pitch index, each step must give what filtering the roll from
+   # scratch gives
+   path = tmp_path / "notes.mid"
+   path.write_bytes (synth_midi (4, 2000, seed=3))
+   roll = import_roll (str (path))[0]
+   session = lamusica.RollSession (roll)
+   roll.pitch_index ()
+   for delta in (1, 240, 121, 960, 0, 480, 5000, 1, 360):
+      expected = import_roll (str (path))[0]
+      count = expected.filter_repetition (delta)
+      assert session.filter (delta) == count
+      assert roll.filtered == expected.filtered
+      assert roll.pitch_index () == expected.pitch_index ()
+      assert roll.voice_index () == expected.voice_index ()
+
+
+def test_scaling (tmp_path):
+   # parsing and the band stages grow about linearly with the notes:
+   # 16 times the notes may take at most 40 times as long
+   def run (notes):
+      path = tmp_path / ("%d.mid" % notes)
+      path.write_bytes (synth_midi (4, notes, meta=False))
+      best = None
+      for i in range (3):
+         start = time.perf_counter ()
+         roll, mi = import_roll (str (path))
+         band_of (roll, lamusica.models["sankyo20"])
+         roll.min_repetition ()
+         seconds = time.perf_counter () - start
+         best = seconds if best is None else min (best, seconds)
+      return best
+
+   small = run (1000)
+   large = run (16000)
+   assert large < 40 * small
+
+
+@pytest.fixture
+def server ():
+   # "lamusica.py serve" on a free port, yields (host, port)
+   import socket, subprocess, sys
+   with socket.socket () as s:
+      s.bind (("127.0.0.1", 0))
+      port = s.getsockname ()[1]
+   proc = subprocess.Popen ([sys.executable, os.path.join (here, "lamusica.py"),
+                             "--box=teanola30", "--jobs=1",
+                             "--listen=127.0.0.1:%d" % port, "serve"],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            text=True)
+   try:
+      assert proc.stdout.readline ().startswith ("serving on")
+      yield "127.0.0.1", port
+   finally:
+      proc.terminate ()
+      proc.wait (10)
+
+
+def post (address, path, body, content_type="audio/midi"):
+   import http.client
+   conn = http.client.HTTPConnection (*address, timeout=60)
+   try:
+      conn.request ("POST", path, body=body, headers={ "Content-Type" : content_type })
+      response = conn.getresponse ()
+      return response.status, dict (response.getheaders ()), response.read ()
+   finally:
+      conn.close ()
+
+
+def test_server_midi (server, tmp_path):
+   import subprocess, sys
+   expected = tmp_path / "expected.mid"
+   subprocess.run ([sys.executable, os.path.join (here, "lamusica.py"),
+                    "--box=teanola30", "--midi=%s" % expected, es_ist],
+                   check=True, capture_output=True)
+   with open (es_ist, "rb") as f:
+      data = f.read ()
+
+   status, headers, body = post (server, "/convert?format=midi", data)
+   assert status == 200
+   assert headers["Content-Type"] == "audio/midi"
+   assert body == expected.read_bytes ()
+   summary = json.loads (headers["X-Summary"])
+   assert summary["box"] == "teanola30"
+   assert summary["notes"] == 286
+   assert summary["holes"] == es_ist_bands["teanola30"][1]
+
+
+def test_server_preview (server):
+   with open (es_ist, "rb") as f:
+      data = f.read ()
+   status, headers, body = post (server, "/convert?format=preview", data)
+   assert status == 200
+   assert headers["Content-Type"] == "image/png"
+   assert body[:8] == b"\x89PNG\r\n\x1a\n"
+
+
+def test_server_errors (server):
+   with open (es_ist, "rb") as f:
+      data = f.read ()
+   assert post (server, "/convert?format=midi&box=nope", data)[0] == 400
+   assert post (server, "/convert?format=midi", b"MThd")[0] == 422
+   assert post (server, "/elsewhere", data)[0] == 404
+
+   # a body cut off before its Content-Length
+   import socket
+   with socket.create_connection (server, timeout=60) as s:
+      s.sendall (b"POST /convert?format=midi HTTP/1.1\r\nContent-Length: %d\r\n\r\n"
+                 % len (data) + data[:100])
+      s.shutdown (socket.SHUT_WR)
+      response = b"".join (iter (lambda: s.recv (65536), b""))
+   assert response.startswith (b"HTTP/1.1 400 ")
+   assert b"request body has 100 of %d bytes" % len (data) in response
+
+
+def roll_of (notes):
+   # a CompactPianoRoll of (note, ticks) pairs, not transposed
+   roll = lamusica.CompactPianoRoll ()
+   for note, ticks in notes:
+      roll.add (lamusica.Note (note, ticks, 0, 0))
+   roll.transpose = 0
+   return roll
+
+
+def repaired (notes, box="sankyo20"):
+   model = lamusica.models[box]
+   roll = roll_of (notes)
+   mindelta = roll.min_repetition ()
+   band, report = lamusica.repair_band (roll.band_sources (), model, mindelta)
+   tines = dict ((n + model["lowest"], i) for i, n in enumerate (model["notes"]))
+   assert not lamusica.tine_collisions (band, lamusica.recovery_ticks (model, mindelta))
+   return band, report, tines
+
+
+def test_collisions_detected ():
+   # C6 is folded onto the C5 tine, 120 ticks after a C5 while C5 repeats
+   # only every 480 ticks
+   model = lamusica.models["sankyo20"]
+   roll = roll_of ([(72, 0), (72, 480), (84, 120)])
+   band = roll.get_compat_band (model)
+   mingap = lamusica.recovery_ticks (model, roll.min_repetition ())
+   assert mingap == 480
+   tine = model["notes"].index (72 - model["lowest"])
+   assert lamusica.tine_collisions (band, mingap) == [(tine, 120, 0), (tine, 480, 120)]
+
+
+def test_repair_refolds ():
+   band, report, tines = repaired ([(72, 0), (72, 480), (84, 120)])
+   assert band[tines[72]] == [0, 480]
+   assert band[tines[60]] == [120]
+   assert (report["collisions"], report["refolded"], report["dropped"]) == (1, 1, 0)
+
+
+def test_repair_nudges_and_drops ():
+   # the other C tines are busy at 120, the C5 tine is free a step later
+   busy = [(60, 120), (48, 120), (50, 0), (50, 480)]
+   band, report, tines = repaired ([(72, 0), (72, 960), (84, 120)] + busy)
+   assert band[tines[72]] == [0, 480, 960]
+   assert (report["nudged"], report["dropped"]) == (1, 0)
+
+   # and not free within a step: dropped
+   band, report, tines = repaired ([(72, 0), (72, 480), (84, 120)] + busy)
+   assert band[tines[72]] == [0, 480]
+   assert (report["nudged"], report["dropped"]) == (0, 1)
+
+
+def test_repair_merged ():
+   # C5 and C6 at the same tick: C6 goes to another C tine, without a
+   # free one it stays merged
+   band, report, tines = repaired ([(72, 0), (84, 0), (72, 480)])
+   assert band[tines[60]] == [0]
+   assert report["merged"] == report["refolded"] == report["unmerged"] == 1
+   band, report, tines = repaired ([(72, 0), (84, 0), (60, 0), (48, 0), (72, 480)])
+   assert band[tines[72]] == [0, 480]
+   assert report["merged"] == 1 and report["refolded"] == report["dropped"] == 0
+   assert report["unmerged"] == 0
+
+
+def test_repair_summary (tmp_path):
+   # the counts are those of the repaired band, the ones before the
+   # repair are kept with its report
+   import subprocess, sys
+   summaries = []
+   for repair in ([], ["--repair"]):
+      path = tmp_path / "summary.json"
+      subprocess.run ([sys.executable, os.path.join (here, "lamusica.py"),
+                       "--box=sankyo15", "--analyze", "--summary=%s" % path,
+                       es_ist] + repair, check=True, capture_output=True)
+      summaries.append (json.loads (path.read_text ())[0])
+   before, after = summaries
+   assert before["merged"] == after["repair"]["unmerged"] == 3
+   assert after["merged"] == after["collisions"] == 0
+   assert after["dropped"] == before["dropped"]
+   assert after["holes"] == before["holes"] + 3
+   assert after["repair"]["before"] == dict ((k, before[k]) for k in
+                                             ("dropped", "merged", "collisions"))
+
+
+def test_voice_transpose_brute_force ():
+   # the branch and bound finds the cheapest of all combinations of
+   # octaves per voice: notes not playable plus notes sharing a slot
+   import random
+   model = lamusica.models["sankyo20"]
+   shifts = [12 * k for k in range (-1, 2)]
+   for seed in range (30):
+      r = random.Random (seed)
+      roll = lamusica.CompactPianoRoll ()
+      for track in range (r.randint (1, 5)):
+         pitches = [r.randint (40, 100) for i in range (r.randint (1, 4))]
+         for i in range (r.randint (1, 25)):
+            roll.add (lamusica.Note (r.choice (pitches), 120 * r.randint (0, 15), 0, track))
+      vindex = roll.voice_index ()
+
+      def cost (transpose):
+         total, slots = 0, set ()
+         for v, index in vindex.items ():
+            folds = model.fold_table (transpose[v])
+            for p in range (128):
+               for t in index[p]:
+                  total += 1
+                  if not 0 <= p + transpose[v] <= 127 or not model.playable[p + transpose[v]]:
+                     total += 1
+                  slots.update ((tine, t) for tine in folds[p])
+         return total - len (slots)
+
+      best = min (cost (dict (zip (sorted (vindex), c)))
+                  for c in itertools.product (shifts, repeat=len (vindex)))
+      with contextlib.redirect_stdout (io.StringIO ()):
+         transpose = roll.find_voice_transpose (model, base=0, octaves=1)
+      assert cost (transpose) == best
+
+
+def test_tempo_map (tmp_path):
+   # a quarter at 120 bpm, then the tempo halves: on the timeline (at the
+   # fastest tempo) the later notes are twice as far apart
+   tempo = lambda usec: vlq (0) + b"\xff\x51\x03" + usec.to_bytes (3, "big")
+   note = lambda delta, n: vlq (delta) + bytes ((0x90, n, 0x40)) + \
+                           vlq (240) + bytes ((0x80, n, 0x00))
+   events = tempo (500000) + note (0, 60) + \
+            vlq (240) + b"\xff\x51\x03" + (1000000).to_bytes (3, "big") + \
+            note (0, 62) + note (240, 64)
+   roll, mi = import_roll (write_midi (tmp_path / "tempo.mid", [events]))
+   tempo_map = mi.tempo_map ()
+   assert not tempo_map.constant and tempo_map.tempo == 500000
+   assert tempo_map.seconds (480) == 0.5
+   assert tempo_map.seconds (960) == 1.5
+   roll.retime (tempo_map)
+   assert note_tuples (roll) == [(60, 0, 0, 0, 240), (62, 480, 0, 0, 480),
+                                 (64, 1440, 0, 0, 480)]
+
+   # the simulation is written at the tempo of the timeline
+   path = tmp_path / "out.mid"
+   model = lamusica.models["sankyo20"]
+   lamusica.output_midi (model, str (path), roll.get_compat_band (model), 480,
+                         mi.timediv, tempo_map.tempo)
+   out, mi = import_roll (str (path))
+   assert mi.tempos == [(0, 500000)]
+   assert [(n.note, n.ticks) for n in out.notes] == [(60, 0), (62, 480), (64, 1440)]
+
+
+def test_tempo_map_constant ():
+   # one tempo (the last of several at the same tick counts) keeps the ticks
+   roll, mi = import_roll (es_ist)
+   before = note_tuples (roll)
+   tempo_map = mi.tempo_map ()
+   assert tempo_map.constant and tempo_map.tempo == 576923
+   roll.retime (tempo_map)
+   assert note_tuples (roll) == before
+
+
+def read_png (path):
+   # (width, height, palette indices without the filter bytes) of an
+   # unfiltered palette PNG as written by write_png
+   import collections, zlib
+   data = path.read_bytes ()
+   assert data[:8] == b"\x89PNG\r\n\x1a\n"
+   chunks = collections.defaultdict (bytes)
+   pos = 8
+   while pos < len (data):
+      length, kind = struct.unpack (">I4s", data[pos:pos + 8])
+      body = data[pos + 8:pos + 8 + length]
+      assert struct.unpack (">I", data[pos + 8 + length:pos + 12 + length])[0] == \
+             zlib.crc32 (kind + body)
+      # the image data may be split over several IDAT chunks
+      chunks[kind] += body
+      pos += 12 + length
+   width, height, depth, color = struct.unpack (">IIBB", chunks[b"IHDR"][:10])
+   assert (depth, color) == (8, 3)
+   raw = zlib.decompress (chunks[b"IDAT"])
+   assert len (raw) == (width + 1) * height
+   assert all (raw[r * (width + 1)] == 0 for r in range (height))
+   pixels = b"".join (raw[r * (width + 1) + 1:(r + 1) * (width + 1)] for r in range (height))
+   return width, height, pixels
+
+
+def test_preview (tmp_path):
+   model = lamusica.models["teanola30"]
+   roll, mi = import_roll (es_ist)
+   band = band_of (roll, model)
+   mindelta = roll.min_repetition ()
+   width, height, pixels = lamusica.render_preview (model, band, mindelta, 2.0, True)
+   assert width == int (lamusica.paper["width"] * 2) + 1
+   assert len (pixels) == width * height
+   assert set (pixels) == set (range (5))
+
+   path = tmp_path / "preview.png"
+   lamusica.output_preview (model, str (path), band, mindelta, True)
+   assert read_png (path) == (width, height, pixels)
+   # noise does not compress much, it is written in several IDAT chunks
+   import random
+   r = random.Random (1)
+   noise = bytes (b % 5 for b in r.randbytes (600 * 400))
+   with open (path, "wb") as f:
+      lamusica.write_png (f, 600, 400, noise, lamusica.preview["colors"], 1024)
+   assert read_png (path) == (600, 400, noise)
+   assert path.read_bytes ().count (b"IDAT") > 1
+
+   # a contact sheet of two thumbnails and an empty tile, 2 x 2
+   thumbnail = lamusica.render_preview (model, band, mindelta, 0.5,
+                                        length=lamusica.paper["height"])
+   sheet = tmp_path / "sheet.png"
+   lamusica.write_contact_sheet (str (sheet), [thumbnail, None, thumbnail])
+   w, h, pixels = read_png (sheet)
+   assert (w, h) == (2 * (thumbnail[0] + 4) + 4, 2 * (thumbnail[1] + 4) + 4)
+   assert pixels.count (2) == 2 * thumbnail[2].count (2)
+
+
+def test_stamp_discs_numpy ():
+   pytest.importorskip ("numpy")
+   spans = lamusica.disc_spans (3.5)
+   centers = [5 * 40 + 5, 20 * 40 + 30, 20 * 40 + 32]
+   a = bytearray (40 * 30)
+   b = bytearray (40 * 30)
+   lamusica.stamp_discs (a, 40, centers, spans, 2)
+   lamusica.stamp_discs_numpy (b, 40, centers, spans, 2)
+   # one disc on its own, two overlapping
+   disc = sum (2 * w + 1 for dy, w in spans)
+   assert a == b and 2 * disc < a.count (2) < 3 * disc
+
+
+def test_wav (tmp_path):
+   pytest.importorskip ("numpy")
+   import wave
+   model = lamusica.models["teanola30"]
+   roll, mi = import_roll (es_ist)
+   band = band_of (roll, model)
+   path = tmp_path / "out.wav"
+   seconds = lamusica.output_wav (model, str (path), band, mi.timediv, 576923)
+   last = max (tine[-1] for tine in band if tine) * 576923 / 1e6 / mi.timediv
+   assert last < seconds <= last + lamusica.synth["length"] + 0.001
+   with wave.open (str (path)) as w:
+      assert (w.getnchannels (), w.getsampwidth ()) == (1, 2)
+      assert w.getnframes () == round (seconds * w.getframerate ())
+      frames = w.readframes (w.getnframes ())
+   samples = struct.unpack ("<%dh" % (len (frames) // 2), frames)
+   assert max (map (abs, samples)) == int (0.9 * 32767)
+
+
+def test_box_models ():
+   for name, model in lamusica.models.items ():
+      definition = lamusica.box_definitions[name]
+      assert model["step"] == model.step == definition["step"]
+      assert model.get ("recovery") == definition.get ("recovery", definition["step"])
+      assert model.pitches == tuple (n + definition["lowest"] for n in definition["notes"])
+      assert [p for p in range (128) if model.playable[p]] == list (model.pitches)
+      # the transposed fold tables are the untransposed one shifted
+      for transpose in (-30, -5, 0, 7, 40):
+         tines = [[] for p in range (128)]
+         for i in range (len (model.pitches)):
+            for n in lamusica.fold_sources (model.pitches, i):
+               if 0 <= n - transpose <= 127:
+                  tines[n - transpose].append (i)
+         assert model.fold_table (transpose) == [tuple (t) for t in tines]
+
+
+@pytest.mark.parametrize ("change, message", [
+   ({ "diameter" : None }, "diameter is missing"),
+   ({ "speed" : -1 }, "speed must be positive"),
+   ({ "speeed" : 6.0 }, "unknown field speeed"),
+   ({ "notes" : [0, 2, 2, 4] }, "notes must rise"),
+   ({ "notes" : [0, 2.5] }, "not a list of integers"),
+   ({ "lowest" : 120 }, "outside of the midi range"),
+   ({ "step" : 0 }, "step must be positive"),
+   ({ "speed" : None, "recovery_time" : 0.05 }, "recovery_time needs the speed"),
+   ({ "recovery_time" : -0.05 }, "recovery_time must be positive"),
+   ({ "height" : "70" }, "height is not a number"),
+])
+def test_box_model_errors (change, message):
+   definition = dict (lamusica.box_definitions["sankyo20"], **change)
+   definition = dict ((k, v) for k, v in definition.items () if v is not None)
+   with pytest.raises (Exception, match=message):
+      lamusica.BoxModel ("broken", definition)
+
+
+def test_recovery_time ():
+   definition = dict (lamusica.box_definitions["sankyo20"], recovery_time=0.1)
+   model = lamusica.BoxModel ("slow", definition)
+   # 0.1 s at 180 turns per minute is 0.3 turns of the paper
+   assert model.recovery == pytest.approx (0.3 * definition["speed"])
+   assert lamusica.recovery_ticks (model, 10) == math.ceil (0.3 * definition["speed"] / definition["step"] * 10)
+   # an explicit recovery distance wins
+   definition["recovery"] = 16.0
+   model = lamusica.BoxModel ("slow", definition)
+   assert model.recovery == 16.0
+   assert lamusica.recovery_ticks (model, 10) == math.ceil (160 / definition["step"])
+
+
+def test_load_models (tmp_path):
+   import subprocess, sys
+   toml = tmp_path / "boxes.toml"
+   toml.write_text ('[pentatonic]\nlowest = 60\nnotes = [0, 2, 4, 7, 9, 12, 14, 16, 19, 21]\n'
+                    'program = 10\nheight = 41\noffset = 6\ndistance = 2\n'
+                    'diameter = 1.8\nstep = 8\n')
+   path = tmp_path / "boxes.json"
+   path.write_text (json.dumps ({ "pentatonic" : { "lowest" : 60,
+                    "notes" : [0, 2, 4, 7, 9, 12, 14, 16, 19, 21], "program" : 10,
+                    "height" : 41, "offset" : 6, "distance" : 2, "diameter" : 1.8,
+                    "step" : 8 } }))
+   boxes = lamusica.load_models (str (path))
+   assert boxes["pentatonic"].key == lamusica.load_models (str (toml))["pentatonic"].key
+   assert boxes["pentatonic"].pitches[:4] == (60, 62, 64, 67)
+   assert boxes["pentatonic"].speed is None
+
+   result = subprocess.run ([sys.executable, os.path.join (here, "lamusica.py"),
+                             "--models=%s" % toml, "--box=pentatonic", "--analyze", es_ist],
+                            capture_output=True, text=True)
+   assert result.returncode == 0
+   assert "unplayable:" in result.stdout
+
+
+def convert_options (**changes):
+   # the options of a command line run with the defaults
+   options = { "box" : "sankyo20", "models" : lamusica.models, "filter" : 1,
+               "transpose" : None, "cost" : "unplayable", "top" : 1,
+               "voices" : None, "midi" : None, "wav" : None, "pdf" : None,
+               "svg" : None, "gcode" : None, "dxf" : None, "preview" : None,
+               "thumbnail" : False, "guides" : False, "render" : "cairo",
+               "split" : "optimal", "cache" : None, "tracks" : None,
+               "stats" : False, "analyze" : False, "repair" : False, "jobs" : 1 }
+   options.update (changes)
+   return options
+
+
+def converted (filename, options):
+   # the summary and the simulation midi file of a conversion
+   with contextlib.redirect_stdout (io.StringIO ()) as out:
+      summary = lamusica.convert_file (filename, options)
+   with open (options["midi"], "rb") as f:
+      return summary, f.read (), out.getvalue ()
+
+
+def test_cache_round_trip (tmp_path):
+   midi = str (tmp_path / "out.mid")
+   expected = converted (es_ist, convert_options (midi=midi, repair=True))[:2]
+   cache = lamusica.RollCache (str (tmp_path / "cache"))
+   options = convert_options (midi=midi, repair=True, cache=cache)
+   cold = converted (es_ist, options)
+   warm = converted (es_ist, options)
+   assert cold[:2] == warm[:2] == expected
+   assert "(cached)" not in cold[2] and "(cached)" in warm[2]
+
+   # an entry of another version is not found, one that cannot be read or
+   # has the wrong shape is a miss
+   digest = cache.file_digest (open (es_ist, "rb"))
+   assert cache.load (digest, ("filter", 1)) is not None
+   cache.version -= 1
+   assert cache.load (digest, ("filter", 1)) is None
+   cache.version += 1
+   import pickle
+   entries = sorted (os.listdir (cache.directory))
+   for k, name in enumerate (entries):
+      with open (os.path.join (cache.directory, name), "wb") as f:
+         if k % 2:
+            f.write (b"\x80\x05garbage")
+         else:
+            pickle.dump (("stale", 1), f)
+   broken = converted (es_ist, options)
+   assert broken[:2] == expected and "(cached)" not in broken[2]
+   assert converted (es_ist, options)[:2] == expected
+
+
+def test_watch_cache (tmp_path):
+   # watch keeps the parsed tracks between the runs, with the cache a
+   # file seen before is not parsed at all. Whatever comes from where,
+   # every run converts the file as it is.
+   def chunks (data):
+      pos, found = 14, []
+      while pos < len (data):
+         size = struct.unpack (">I", data[pos + 4:pos + 8])[0]
+         found.append (data[pos:pos + 8 + size])
+         pos += 8 + size
+      return found
+   first = synth_midi (4, 400, seed=1)
+   other = chunks (synth_midi (4, 400, seed=2))
+   second = first[:14] + b"".join (chunks (first)[:3] + other[3:])
+
+   path = tmp_path / "song.mid"
+   midi = str (tmp_path / "out.mid")
+   options = convert_options (midi=midi, tracks={},
+                              cache=lamusica.RollCache (str (tmp_path / "cache")))
+   for data in (first, first, second, first, second):
+      path.write_bytes (data)
+      expected = converted (str (path), convert_options (midi=midi))[:2]
+      assert converted (str (path), options)[:2] == expected
+
+
+def random_splits (seed):
+   # (times, step, radius, leadin, length, maxwidth) of a small random band
+   import random
+   r = random.Random (seed)
+   times = sorted (set (r.randint (0, 60) for i in range (r.randint (2, 12))))
+   step, radius, leadin = r.choice ([1.5, 2.5, 5.0]), 1.0, 20.0
+   length = (times[-1] - times[0]) * step + 2 * radius + 2 * leadin
+   return times, step, radius, leadin, length, r.choice ([40, 60, 80, 120])
+
+
+def test_split_optimal_brute_force ():
+   # the dynamic program finds the best (strips, narrow breaks, -narrowest
+   # break) of all layouts that fit
+   for seed in range (600):
+      times, step, radius, leadin, length, maxwidth = random_splits (seed)
+      cand = [(leadin + (a + b - 2 * times[0]) * step / 2, (b - a) * step)
+              for a, b in zip (times, times[1:]) if (b - a) * step > 2 * radius]
+      key = lambda c: (len (c) + 1, sum (g <= 4 * radius for p, g in c),
+                       max ([-g for p, g in c], default=-float ("inf")))
+      best = None
+      for k in range (len (cand) + 1):
+         for c in itertools.combinations (cand, k):
+            if lamusica.splits_fit ([0.0] + [p for p, g in c] + [length], maxwidth):
+               best = key (c) if best is None else min (best, key (c))
+      splits = lamusica.split_optimal (times, step, radius, leadin, length, maxwidth)
+      if best is None:
+         continue
+      assert lamusica.splits_fit (splits, maxwidth)
+      assert key ([c for c in cand if c[0] in splits[1:-1]]) == best
+
+
+def test_split_greedy ():
+   for seed in range (600):
+      args = random_splits (seed)
+      times, step, radius, leadin, length, maxwidth = args
+      greedy = lamusica.split_greedy (*args)
+      # no empty strips, and the optimal split never needs more strips
+      # than a greedy one that fits
+      assert all (a < b for a, b in zip (greedy, greedy[1:]))
+      if lamusica.splits_fit (greedy, maxwidth):
+         assert len (lamusica.split_optimal (*args)) <= len (greedy)
+
+   # a piece that does not start at tick 0 breaks between its holes
+   times = [1000 + 10 * i for i in range (40)]
+   splits = lamusica.split_greedy (times, 1.0, 1.0, 20.0, 20.0 + 390 + 2 + 20.0, 100)
+   holes = [20.0 + t - 1000 for t in times]
+   assert len (splits) > 2
+   assert all (abs (s - x) > 1.0 for s in splits[1:-1] for x in holes)
+
+   # the lead-out counts: the last hole fits, the strip end does not
+   splits = lamusica.split_greedy ([0, 10, 50], 1.0, 1.0, 20.0, 20.0 + 50 + 2 + 20.0, 80)
+   assert splits == [0.0, 50.0, 92.0]
+
+
+def test_layout_without_holes (tmp_path):
+   # transposed off the box, the band is empty: midi and the layout work
+   model = lamusica.models["sankyo20"]
+   band = [[] for tine in model.notes]
+   assert lamusica.layout_splits (model, band, 480, 260) == [0.0, 40.0]
+   usage = lamusica.paper_usage (model, band, 480)
+   assert (usage["strips"], usage["pages"], usage["fits"]) == (1, 1, True)
+   lamusica.output_midi (model, str (tmp_path / "empty.mid"), band, 480, 480)